@@ -0,0 +1,235 @@
+from nmigen import *
+from nmigen.sim import *
+import math
+import sys
+import time
+import numpy as np
+
+from sigma_delta_adc import SigmaDelta_ADC, SigmaDelta_ADC_SecondOrder
+from spectrum import sinad_db
+
+# Analog side of the sigma-delta ADCs, for the nMigen simulator and for fast runs of long
+# tests. The input, comparator noise and output decimation are done a block at a time with
+# NumPy; only the loop through the comparator is stepped clock by clock, in plain Python
+# with the digital state of the ADC modelled alongside, which is several hundred times
+# faster than the simulator. run_first_order and run_second_order are bit-exact with the
+# gateware driven by Analog_Frontend.cosim, given the same frontend and seed.
+
+class Analog_Frontend:
+    # Each feedback pin drives the integrating capacitor through its own resistor, pin 0
+    # first, and the comparator compares the input with the capacitor voltage. Every clock
+    # the capacitor moves towards the Thevenin voltage of the pins (exactly, as an RC step
+    # response), then the comparator decides. offset is added to the capacitor side,
+    # hysteresis is the full width of the band the comparator holds its output across and
+    # noise is the RMS of gaussian noise on its input, drawn fresh every clock.
+    # The defaults are the 0.05 per clock RC of the original sigma_delta_adc.py test.
+    def __init__(self, resistors=(1e3,), capacitance=195e-12, supply=1.0, clock=100e6,
+        offset=0.0, hysteresis=0.0, noise=0.0, seed=None, start=None):
+        if (min(resistors) <= 0) or (capacitance <= 0):
+            raise ValueError('Resistors and capacitance must be positive')
+
+        conductances = [1/r for r in resistors]
+        self.levels = [supply*sum(g for pin, g in enumerate(conductances) if (code >> pin) & 1)/
+            sum(conductances) for code in range(0, 2**len(resistors))]
+        self.decay = math.exp(-sum(conductances)/(clock*capacitance))
+        self.drive = [level*(1-self.decay) for level in self.levels]
+        self.thresholds = [hysteresis/2, -hysteresis/2]     # From low, from high
+        self.supply = supply
+        self.clock = clock
+        self.offset = offset
+        self.hysteresis = hysteresis
+        self.noise = noise
+        self.seed = seed
+        self.start = supply/2 if start is None else start
+        self.reset()
+
+    def reset(self):
+        self.node = self.start
+        self.comparator = 0
+        self.rng = np.random.default_rng(self.seed)
+
+    def step(self, feedback, input):
+        # One clock with feedback on the pins, returns the comparator output. input is as
+        # from blocks, with the offset and noise already applied.
+        self.node = self.node*self.decay + self.drive[feedback]
+        self.comparator = int(input - self.node > self.thresholds[self.comparator])
+        return self.comparator
+
+    def blocks(self, waveform, clocks, block):
+        # Comparator input less offset and noise, for each block of up to block clocks
+        for start in range(0, clocks, block):
+            count = min(block, clocks - start)
+            inputs = waveform(start, count) - self.offset
+            if self.noise:
+                inputs += self.rng.normal(0, self.noise, count)
+            yield inputs.tolist()
+
+    def cosim(self, dut, waveform, clocks, block=2**16):
+        # Sync process for a Simulator, in place of sigma_delta_adc.py's circuit(). Settle
+        # before reading the feedback so the comparator is decided from this clock's
+        # feedback, and is registered at the next edge as it would be in hardware. The
+        # design has already been clocked once, with the comparator low, when this starts.
+        def circuit():
+            for inputs in self.blocks(waveform, clocks, block):
+                for input in inputs:
+                    yield Settle()
+                    feedback = yield dut.feedback
+                    yield dut.comparator.eq(self.step(feedback, input))
+                    yield
+        return circuit
+
+# Waveforms, as functions of (first clock, clocks) returning the input voltage each clock
+
+def dc_level(level):
+    def waveform(start, count):
+        return np.full(count, float(level))
+    return waveform
+
+def sine_wave(frequency, amplitude, offset, clock=100e6):
+    def waveform(start, count):
+        return offset + amplitude*np.sin(2*np.pi*frequency/clock*np.arange(start, start+count))
+    return waveform
+
+def ramp(start_level, end_level, clocks):
+    def waveform(start, count):
+        n = np.minimum(np.arange(start, start+count), clocks)
+        return start_level + (end_level - start_level)*n/clocks
+    return waveform
+
+def levels(values, clocks_each):
+    # values[0] for clocks_each clocks, then values[1] and so on, holding the last
+    def waveform(start, count):
+        n = np.minimum(np.arange(start, start+count)//clocks_each, len(values)-1)
+        return np.asarray(values, dtype=np.float64)[n]
+    return waveform
+
+def aligned_block(block, period):
+    return max(1, block//period)*period
+
+# The fast runs step one clock edge at a time from the first out of reset, which registers
+# the comparator's reset value, 0, then the front end decides from the new feedback ready
+# for the next edge. Each returns one value per conversion completed, starting with the
+# first that includes any of the front end's decisions.
+
+def run_first_order(adc, frontend, waveform, clocks, block=2**16):
+    # SigmaDelta_ADC output. The counter wraps at the next power of two above k-1, and the
+    # decision registered on the edge the accumulator is dumped is not counted, as in the
+    # gateware.
+    counter_bits = (adc.k-1).bit_length()
+    period = 2**counter_bits
+    output_mask = 2**len(adc.output) - 1
+    block = aligned_block(block, period)
+    outputs = []
+    step = frontend.step
+    feedback = 0
+    for inputs in frontend.blocks(waveform, clocks - clocks % period, block):
+        decisions = []
+        for input in inputs:
+            decisions.append(feedback)
+            feedback = step(feedback, input)
+        decisions = np.array(decisions, dtype=np.int64).reshape(-1, period)
+        outputs.append(decisions[:, 1:].sum(axis=1) & output_mask)
+    return np.concatenate(outputs) if outputs else np.zeros(0, dtype=np.int64)
+
+def run_second_order(adc, frontend, waveform, clocks, block=2**16):
+    # SigmaDelta_ADC_SecondOrder raw_output, pass these through adc.model_output for the
+    # calibrated output.
+    bits = adc.bits
+    full_scale = 2**bits - 1
+    mask = 2**bits - 1
+    up = adc.step
+    k_log2 = adc.k.bit_length()-1
+    block = aligned_block(block, adc.k)
+    outputs = []
+    step = frontend.step
+    integrator = 2**(bits-1)
+    dac_error = 0
+    comparator = 0
+    for inputs in frontend.blocks(waveform, clocks - clocks % adc.k, block):
+        history = []
+        for input in inputs:
+            history.append(integrator)
+            dac_sum = dac_error + integrator*3
+            dac_error = dac_sum & mask
+            integrator = min(integrator + up, full_scale) if comparator else max(integrator - up, 0)
+            comparator = step(dac_sum >> bits, input)
+        history = np.array(history, dtype=np.int64).reshape(-1, adc.k)
+        outputs.append(history.sum(axis=1) >> k_log2)
+    return np.concatenate(outputs) if outputs else np.zeros(0, dtype=np.int64)
+
+if __name__=="__main__":
+
+    # Both ADCs in the simulator against the fast runs, with comparator offset, hysteresis
+    # and noise, then a long sine test of each from the fast runs alone
+    frontend_args = dict(offset=0.003, hysteresis=0.002, noise=0.001, seed=1)
+    check_clocks = 64*64
+    tone = sine_wave(48.828125e3, 0.35, 0.5)
+    long_clocks = 2**int(sys.argv[1]) if len(sys.argv) > 1 else 2**22
+
+    for name, adc, resistors, run in [
+            ("SigmaDelta_ADC", SigmaDelta_ADC(k=64), (1e3,), run_first_order),
+            ("SigmaDelta_ADC_SecondOrder", SigmaDelta_ADC_SecondOrder(k=64), (2e3, 1e3),
+                run_second_order)]:
+        output = adc.output if run is run_first_order else adc.raw_output
+        simulated = []
+
+        def record():
+            for n in range(0, check_clocks):
+                yield Settle()
+                if (yield adc.new_output):
+                    simulated.append((yield output))
+                yield
+
+        frontend = Analog_Frontend(resistors=resistors, **frontend_args)
+        sim = Simulator(adc)
+        sim.add_clock(10e-9) #100MHz
+        sim.add_sync_process(frontend.cosim(adc, tone, check_clocks))
+        sim.add_sync_process(record)
+        start = time.perf_counter()
+        sim.run()
+        sim_rate = check_clocks/(time.perf_counter()-start)
+
+        frontend = Analog_Frontend(resistors=resistors, **frontend_args)
+        modelled = run(adc, frontend, tone, check_clocks)
+        print(name, "matches simulator:", list(modelled[0:len(simulated)-1]) == simulated[1:])
+
+        frontend = Analog_Frontend(resistors=resistors, **frontend_args)
+        start = time.perf_counter()
+        outputs = run(adc, frontend, tone, long_clocks)
+        fast_rate = long_clocks/(time.perf_counter()-start)
+        sinad = sinad_db(outputs[8:], 48.828125e3*adc.k/100e6)
+        print("   ", long_clocks, "clocks: SINAD", round(sinad, 1), "dB,", round((sinad-1.76)/6.02, 2),
+            "effective bits,", round(fast_rate/1e6, 2), "M clocks/s against",
+            round(sim_rate/1e3, 1), "k clocks/s simulated")
+
+    # Calibration with a low supply, on the references held for holds conversions each, then
+    # reading a level between them. The holds change half way through a conversion, so
+    # conversion n is measured by a hold that covers the clock it ends on
+    adc = SigmaDelta_ADC_SecondOrder(k=64, average_log2=2)
+    holds = 12
+    clocks = 3*holds*adc.k
+    levels_waveform = levels((0.25, 0.75, 0.6), holds*adc.k)
+    frontend_args.update(resistors=(2e3, 1e3), supply=0.97)
+    simulated = []
+
+    def control():
+        for n in range(0, clocks):
+            yield adc.calibrate_low_i.eq(adc.k//2 <= n < holds*adc.k + adc.k//2)
+            yield adc.calibrate_high_i.eq(holds*adc.k + adc.k//2 <= n < 2*holds*adc.k + adc.k//2)
+            yield Settle()
+            if (yield adc.new_output):
+                simulated.append((yield adc.output))
+            yield
+
+    frontend = Analog_Frontend(**frontend_args)
+    sim = Simulator(adc)
+    sim.add_clock(10e-9) #100MHz
+    sim.add_sync_process(frontend.cosim(adc, levels_waveform, clocks))
+    sim.add_sync_process(control)
+    sim.run()
+
+    raw = run_second_order(adc, Analog_Frontend(**frontend_args), levels_waveform, clocks)
+    modelled = adc.model_output(raw, raw[0:holds], raw[holds:2*holds])
+    print("Calibration matches simulator:",
+        list(modelled[2*holds:len(simulated)-1]) == simulated[2*holds+1:],
+        "reading", simulated[-1], "raw", raw[-1], "expected", round(0.6*2**adc.bits))
@@ -0,0 +1,203 @@
+from nmigen import *
+from nmigen.sim import *
+import math
+import numpy as np
+from scipy import signal
+
+from fir_pipelined import FIR_Pipelined
+
+def cic_width(order, ratio, differential_delay=1, input_width=1, signed_input=False):
+    # Register width needed for the full CIC gain of (ratio*differential_delay)**order
+    gain = (ratio*differential_delay)**order
+    if signed_input:
+        return ((2**(input_width-1))*gain - 1).bit_length() + 1
+    return (((2**input_width)-1)*gain).bit_length()
+
+def cic_compensation(order, ratio, differential_delay=1, taps=15, cutoff=0.25):
+    # Inverse sinc**order FIR at the decimated rate, flat to cutoff (fraction of the output
+    # Nyquist rate) then lowpass. Floats for FIR_Pipelined, where 1.0 is full scale. The gain
+    # is left alone unless a coefficient is over 1, then they are all scaled down to fit. The
+    # 1-2**-15 factor stops the largest rounding up to full scale, for widths of 16 or more.
+    freq = np.linspace(0, 1, 256)
+    f = freq[1:]/2  # cycles per output sample
+    droop = np.abs(np.sin(math.pi*f*differential_delay) /
+        (ratio*np.sin(math.pi*f*differential_delay/ratio)))**order
+    gain = np.concatenate(([1], 1/droop))
+    gain[freq > cutoff] = 0
+    coefficients = signal.firwin2(taps, freq, gain)
+    return coefficients*(1 - 2**-15)/max(1, np.max(np.abs(coefficients)))
+
+class CIC_Decimator(Elaboratable):
+    # Multiplierless decimator: order integrators at the input rate, keep one sample in
+    # ratio, then order combs with differential_delay at the output rate. Wrap around in the
+    # integrators cancels out in the combs, so registers only need cic_width bits.
+    # The default 1 bit unsigned input takes SigmaDelta_ADC.comparator directly, with
+    # input_ready_i tied high. compensation_taps > 0 adds a FIR_Pipelined with an inverse sinc
+    # response after the combs, which halves the gain as FIR_Pipelined always does.
+    def __init__(self, order=3, ratio=64, differential_delay=1, input_width=1, signed_input=False,
+        compensation_taps=0, compensation_cutoff=0.25, macc_width=48):
+        if ratio < 2:
+            raise ValueError('Decimation ratio must be at least 2')
+
+        self.order = order
+        self.ratio = ratio
+        self.differential_delay = differential_delay
+        self.input_width = input_width
+        self.signed_input = signed_input
+        self.width = cic_width(order, ratio, differential_delay, input_width, signed_input)
+
+        self.input = Signal(shape=Shape(width=input_width, signed=signed_input))
+        self.input_ready_i = Signal()
+        self.output_ready_o = Signal()
+
+        self.compensator = None
+        if compensation_taps:
+            # FIR_Pipelined is signed, so unsigned CIC outputs need one more bit
+            fir_width = self.width if signed_input else self.width+1
+            self.compensator = FIR_Pipelined(width=fir_width, macc_width=max(macc_width, 2*fir_width),
+                coefficients=cic_compensation(order, ratio, differential_delay,
+                    compensation_taps, compensation_cutoff))
+            if self.compensator.latency > ratio:
+                raise ValueError('Compensation FIR is too long to run at the decimated rate')
+            self.output = Signal(signed(fir_width))
+        else:
+            self.output = Signal(shape=Shape(width=self.width, signed=signed_input))
+
+    def elaborate(self, platform):
+        m = Module()
+
+        width = self.width
+
+        # Each integrator adds the previous stage's registered value
+        integrators = [Signal(width, name="integrator_"+str(k)) for k in range(0, self.order)]
+        with m.If(self.input_ready_i):
+            m.d.sync += integrators[0].eq(integrators[0] + self.input)
+            for k in range(1, self.order):
+                m.d.sync += integrators[k].eq(integrators[k] + integrators[k-1])
+
+        count = Signal(range(self.ratio))
+        strobe = Signal()
+        decimated = Signal(width)
+        m.d.sync += strobe.eq(0)
+        with m.If(self.input_ready_i):
+            with m.If(count == self.ratio-1):
+                m.d.sync += [
+                    count.eq(0),
+                    decimated.eq(integrators[-1]),
+                    strobe.eq(1),
+                ]
+            with m.Else():
+                m.d.sync += count.eq(count+1)
+
+        # Combs, one stage per clock after the strobe
+        comb_input = decimated
+        for k in range(0, self.order):
+            history = [Signal(width, name="comb_"+str(k)+"_delay_"+str(n))
+                for n in range(0, self.differential_delay)]
+            comb = Signal(width, name="comb_"+str(k))
+            comb_strobe = Signal(name="comb_strobe_"+str(k))
+            m.d.sync += comb_strobe.eq(strobe)
+            with m.If(strobe):
+                m.d.sync += [
+                    comb.eq(comb_input - history[-1]),
+                    history[0].eq(comb_input),
+                ]
+                for n in range(1, self.differential_delay):
+                    m.d.sync += history[n].eq(history[n-1])
+            comb_input = comb
+            strobe = comb_strobe
+
+        if self.compensator is None:
+            m.d.comb += [
+                self.output.eq(comb_input),
+                self.output_ready_o.eq(strobe),
+            ]
+        else:
+            m.submodules.compensator = fir = self.compensator
+            m.d.comb += [
+                fir.input.eq(comb_input.as_signed() if self.signed_input else comb_input),
+                fir.input_ready_i.eq(strobe),
+                self.output.eq(fir.output),
+                self.output_ready_o.eq(fir.output_ready_o),
+            ]
+
+        return m
+
+    def model(self, inputs):
+        # Bit-exact CIC output (without the compensation FIR) for a stream of inputs
+        mask = (2**self.width)-1
+        values = np.asarray(inputs, dtype=np.int64)
+        for k in range(0, self.order):
+            values = np.concatenate(([0], np.cumsum(values)[:-1])) & mask
+        values = values[self.ratio-1::self.ratio]
+        for k in range(0, self.order):
+            delayed = np.concatenate((np.zeros(self.differential_delay, dtype=np.int64),
+                values[:-self.differential_delay]))
+            values = (values - delayed) & mask
+        if self.signed_input:
+            values = np.where(values >= 2**(self.width-1), values - 2**self.width, values)
+        return values
+
+if __name__=="__main__":
+    from spectrum import sinad_db
+
+    # 1 bit first order sigma-delta stream of a slow sine, like SigmaDelta_ADC's comparator.
+    # Compare CIC orders against the count-and-dump SigmaDelta_ADC uses (order 1).
+    ratio = 64
+    samples = ratio*256
+    t = np.arange(samples)
+    x = 0.5 + 0.4*np.sin(2*math.pi*t*3/256/ratio)
+    bits = np.zeros(samples, dtype=np.int64)
+    integrator = 0
+    for n in range(0, samples):
+        integrator += x[n]
+        bits[n] = 1 if integrator >= 1 else 0
+        integrator -= bits[n]
+
+    print("Order, output width, SINAD (dB), ENOB")
+    for order in range(1, 5):
+        dut = CIC_Decimator(order=order, ratio=ratio)
+        # Skip the start up transient of the combs
+        sinad = sinad_db(dut.model(bits)[order+1:], 3/256)
+        print(str(order) + ", " + str(dut.width) + ", " + str(round(sinad, 1)) + ", " +
+            str(round((sinad-1.76)/6.02, 1)))
+
+    # Check the gateware against the model
+    dut = CIC_Decimator(order=3, ratio=16, differential_delay=2)
+    outputs = []
+
+    def tb():
+        yield dut.input_ready_i.eq(1)
+        for n in range(0, 16*40):
+            yield dut.input.eq(int(bits[n]))
+            yield
+            if (yield dut.output_ready_o):
+                outputs.append((yield dut.output))
+
+    sim = Simulator(dut)
+    sim.add_clock(10e-9) #100MHz
+    sim.add_sync_process(tb)
+    sim.run()
+    expected = dut.model(bits[0:16*40]).tolist()
+    print("Simulation matches model:", outputs == expected[0:len(outputs)], len(outputs), "outputs")
+
+    # With compensation the FIR must take every decimated sample, even at the smallest ratio
+    # its latency allows
+    dut = CIC_Decimator(order=2, ratio=11, compensation_taps=7)
+    outputs = []
+
+    def tb():
+        yield dut.input_ready_i.eq(1)
+        for n in range(0, 11*40):
+            yield dut.input.eq(int(bits[n]))
+            yield
+            if (yield dut.output_ready_o):
+                outputs.append((yield dut.output))
+
+    sim = Simulator(dut)
+    sim.add_clock(10e-9) #100MHz
+    sim.add_sync_process(tb)
+    sim.run()
+    expected = dut.compensator.model(dut.model(bits[0:11*40])).tolist()
+    print("Compensated at ratio", dut.ratio, "matches model:", outputs == expected[0:len(outputs)],
+        len(outputs), "of", len(expected), "outputs")
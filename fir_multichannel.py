@@ -0,0 +1,182 @@
+from nmigen import *
+from nmigen.sim import *
+from nmigen.lib.fifo import SyncFIFO
+import math
+
+from fir_pipelined import gen_coefficients
+
+class FIR_MultiChannel(Elaboratable):
+    # One MAC and one coefficient ROM shared between channels. Every channel has its own
+    # taps long circular delay line in a single samples Memory, at channel*taps, with a write
+    # pointer per channel, so only one sample is written per input. Inputs are tagged with
+    # input_channel_i and queued in a FIFO (depth channels by default, so every channel can
+    # arrive on consecutive clocks), then filtered one at a time taking latency clocks each.
+    # Outputs come out tagged with output_channel_o. Inputs arriving with the FIFO full are
+    # dropped, all channels together must average at least latency clocks per input.
+    def __init__(self, channels=2, width = 16, taps=16, cutoff=0.5, filter_type='lowpass',
+        output_width = None, macc_width=32, fifo_depth=None):
+        if channels < 1:
+            raise ValueError('Need at least one channel')
+        if(width*2 > macc_width):
+            raise ValueError('MACC width must be at least 2*sample width')
+
+        self.coefficients = gen_coefficients(width, taps, cutoff, filter_type)
+
+        if output_width == None:
+            self.output_width = width
+        else:
+            self.output_width = output_width
+        self.channels = channels
+        self.macc_width = macc_width
+        self.width = width
+        self.sample = Shape(width=self.width, signed=True)
+        self.taps = taps
+        self.fifo_depth = fifo_depth if fifo_depth else channels
+        self.latency = taps + 3     # min. number of clock cycles per sample, of any channel
+
+        self.input = Signal(shape = self.sample)
+        self.input_channel_i = Signal(range(channels))
+        self.input_ready_i = Signal()
+        self.output = Signal(signed(self.output_width))
+        self.output_channel_o = Signal(range(channels))
+        self.output_ready_o = Signal()
+        self.accumulator = Signal(shape = Shape(width=self.macc_width, signed=True))
+
+    def elaborate(self, platform):
+        m = Module()
+
+        taps = self.taps
+
+        m.submodules.fifo = fifo = SyncFIFO(width=self.width+len(self.input_channel_i),
+            depth=self.fifo_depth)
+        m.d.comb += [
+            fifo.w_data.eq(Cat(self.input, self.input_channel_i)),
+            fifo.w_en.eq(self.input_ready_i),
+        ]
+        next_sample = fifo.r_data[0:self.width]
+        next_channel = fifo.r_data[self.width:]
+
+        # Memory contents are unsigned, so store the coefficients as two's complement
+        samples = Memory(width=self.width, depth=self.channels*taps, name="samples")
+        coefficients = Memory(width=self.width, depth=taps, name="coefficients",
+            init=[c % 2**self.width for c in self.coefficients])
+        m.submodules.sample_write = sample_write = samples.write_port()
+        m.submodules.sample_read = sample_read = samples.read_port(transparent=False)
+        m.submodules.coefficient_read = coefficient_read = coefficients.read_port(transparent=False)
+
+        pointers = Array(Signal(range(taps), name="pointer_"+str(n)) for n in range(0, self.channels))
+        channel = Signal(range(self.channels))
+        base = Signal(range(self.channels*taps))
+        pointer = Signal(range(taps))
+        tap = Signal(range(taps))
+        index = Signal(range(taps))
+
+        # Newest sample (at the pointer) goes with coefficient 0, counting back round the buffer
+        m.d.comb += [
+            pointer.eq(pointers[channel]),
+            index.eq(Mux(tap > pointer, pointer + taps - tap, pointer - tap)),
+            sample_read.addr.eq(base + index),
+            coefficient_read.addr.eq(tap),
+        ]
+
+        # Read data arrives the clock after the address, first and valid follow it
+        first = Signal()
+        valid = Signal()
+        m.d.sync += [
+            first.eq(0),
+            valid.eq(0),
+            self.output_ready_o.eq(0),
+        ]
+
+        accumulator = self.accumulator
+        product = sample_read.data.as_signed()*coefficient_read.data.as_signed()
+        with m.If(first):
+            m.d.sync += accumulator.eq(product)
+        with m.Elif(valid):
+            m.d.sync += accumulator.eq(accumulator + product)
+
+        with m.FSM() as fir_fsm:
+            with m.State("WAIT"):
+                with m.If(fifo.r_rdy):
+                    m.next = "PROCESSING"
+                    m.d.comb += [
+                        fifo.r_en.eq(1),
+                        sample_write.addr.eq(next_channel*taps + pointers[next_channel]),
+                        sample_write.data.eq(next_sample),
+                        sample_write.en.eq(1),
+                    ]
+                    m.d.sync += [
+                        channel.eq(next_channel),
+                        base.eq(next_channel*taps),
+                        tap.eq(0),
+                    ]
+
+            with m.State("PROCESSING"):
+                m.d.sync += [
+                    first.eq(tap == 0),
+                    valid.eq(1),
+                    tap.eq(tap+1),
+                ]
+                with m.If(tap == taps-1):
+                    m.next = "PIPELINE_CLEAR"
+
+            with m.State("PIPELINE_CLEAR"):
+                # last product is being accumulated
+                m.next = "SAVE"
+
+            with m.State("SAVE"):
+                m.next = "WAIT"
+                m.d.sync += [
+                    self.output_ready_o.eq(1),
+                    self.output.eq(accumulator[(2*self.width)-self.output_width:2*self.width]),
+                    self.output_channel_o.eq(channel),
+                    pointers[channel].eq(Mux(pointer == taps-1, 0, pointer+1)),
+                ]
+
+        return m
+
+if __name__=="__main__":
+
+    # Each channel should match a separate filter. Stereo AC97 style: all channels arrive
+    # together on consecutive clocks once a frame
+    from fir_pipelined import fir_model
+    import random
+
+    def run(dut, inputs, period):
+        outputs = [[] for c in range(0, dut.channels)]
+        frames = len(inputs[0])
+
+        def tb():
+            for t in range(0, frames*period + 100*dut.latency):
+                frame, offset = divmod(t, period)
+                if (frame < frames) and (offset < dut.channels):
+                    yield dut.input.eq(inputs[offset][frame])
+                    yield dut.input_channel_i.eq(offset)
+                    yield dut.input_ready_i.eq(1)
+                else:
+                    yield dut.input_ready_i.eq(0)
+                yield
+                if (yield dut.output_ready_o):
+                    outputs[(yield dut.output_channel_o)].append((yield dut.output))
+
+        sim = Simulator(dut)
+        sim.add_clock(10e-9) #100MHz
+        sim.add_sync_process(tb)
+        sim.run()
+        return outputs
+
+    print("Channels, taps, clocks per frame, matches separate filters")
+    for channels, taps in [(1, 16), (2, 33), (4, 21)]:
+        dut = FIR_MultiChannel(channels=channels, width=16, taps=taps, macc_width=48)
+        inputs = [[random.randint(-2**15, 2**15-1) for n in range(0, 40)] for c in range(0, channels)]
+        period = channels*dut.latency
+        outputs = run(dut, inputs, period)
+        matches = all(outputs[c] == fir_model(dut.coefficients, inputs[c], 16, 16, 48).tolist()
+            for c in range(0, channels))
+        print(str(channels) + ", " + str(taps) + ", " + str(period) + ", " + str(matches))
+
+    # 100MHz clock and 44.1kHz frames leave room for many channels of a long filter
+    frame_clocks = math.floor(100e6/44.1e3)
+    dut = FIR_MultiChannel(channels=2, taps=33)
+    print("33 taps at 44.1kHz and 100MHz: up to", frame_clocks//dut.latency,
+        "channels on one MAC")
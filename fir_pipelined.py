@@ -1,18 +1,79 @@
 from nmigen import *
 from nmigen.sim import *
 import math
+import numpy as np
 from scipy import signal
 
+from mac import MAC
+
+def gen_coefficients(width, taps, cutoff, filter_type='lowpass'):
+    # Quantized firwin design, scaled so that 1.0 is 2**(width-1)
+    fir_coeff = (signal.firwin(taps, cutoff, pass_zero=filter_type)*2**(width-1))
+    coefficients = []
+    for n in range(0, taps):
+        coefficients.append(round(fir_coeff[n]))
+    return coefficients
+
+def fir_model(coefficients, inputs, width, output_width, macc_width, shift=0):
+    # Bit-exact outputs of a single MAC FIR, one per input, starting from an empty delay
+    # line: integer coefficients where 2**(width-1) is 1.0, and output_width bits of the
+    # accumulator taken from just below bit 2*width-shift. int64 arithmetic wraps modulo
+    # 2**64, so the sums are exact in every bit of a macc_width <= 64 accumulator, and the
+    # output slice stops below 2*width anyway.
+    if macc_width > 64:
+        raise ValueError('Model only supports accumulators up to 64 bits')
+    samples = np.asarray(inputs, dtype=np.int64)
+    samples = ((samples + 2**(width-1)) % 2**width) - 2**(width-1)
+    coefficients = np.array(coefficients, dtype=np.int64)
+    accumulator = np.convolve(samples, coefficients)[0:len(samples)].astype(np.uint64)
+    output = ((accumulator >> np.uint64(2*width-shift-output_width)) &
+        np.uint64(2**output_width-1)).astype(np.int64)
+    return np.where(output >= 2**(output_width-1), output - 2**output_width, output)
+
+def simulate(dut, inputs, period, flush=100):
+    # Outputs of a FIR with input, input_ready_i, output and output_ready_o ports, given
+    # inputs one every period clocks, running on for flush clocks after the last one.
+    # input_ready_i is only written when it changes, each command costs simulator time.
+    outputs = []
+
+    def tb():
+        ready = False
+        for t in range(0, len(inputs)*period + flush):
+            feed = (t % period == 0) and (t//period < len(inputs))
+            if feed:
+                yield dut.input.eq(int(inputs[t//period]))
+            if feed != ready:
+                yield dut.input_ready_i.eq(feed)
+                ready = feed
+            yield
+            if (yield dut.output_ready_o):
+                outputs.append((yield dut.output))
+
+    sim = Simulator(dut)
+    sim.add_clock(10e-9) #100MHz
+    sim.add_sync_process(tb)
+    sim.run()
+    return outputs
+
 class FIR_Pipelined(Elaboratable):
     def __init__(self, width = 16, taps=16, cutoff=0.5, filter_type='lowpass', 
-        output_width = None, macc_width=32):
+        output_width = None, macc_width=32, folded=False, coefficients=None,
+        coefficient_write=False, mac_stages=(1, 1, 0, 1), fabric_multiply=False):
  
-        fir_coeff = (signal.firwin(taps, cutoff, pass_zero=filter_type)*2**(width-1))
-        self.coefficients = []
-        for n in range(0, taps):
-            self.coefficients.append(round(fir_coeff[n]))
+        # coefficients overrides the firwin design, as floats where 1.0 is full scale
+        if coefficients is None:
+            self.coefficients = gen_coefficients(width, taps, cutoff, filter_type)
+        else:
+            self.coefficients = [round(c*2**(width-1)) for c in coefficients]
+            taps = len(self.coefficients)
         self.coefficients.append(0)
 
+        # Folded mode pre-adds the two samples that share a coefficient, firwin designs are
+        # linear phase so the coefficients are symmetric
+        self.folded = folded
+        if folded and (self.coefficients[0:taps] != self.coefficients[taps-1::-1]):
+            raise ValueError('Folded FIR needs symmetric coefficients')
+
         if(width*2 > macc_width):
             raise ValueError('MACC width must be at least 2*sample width')
         #if((width*2 + math.ceil(math.log2(taps))) >= macc_width):
@@ -25,7 +86,22 @@ class FIR_Pipelined(Elaboratable):
         self.width = width
         self.sample = Shape(width=self.width, signed=True)
         self.taps = len(self.coefficients)-1
-        self.latency = self.taps + 3    # min. number of clock cycles per sample
+        self.macs = (self.taps+1)//2 if folded else self.taps  # multiplies per sample
+
+        # mac_stages is the A/B/M/P register depths, (1, 1, 1, 1) registers the multiplier
+        # output as well for full DSP48 Fmax. The pipeline is cleared for all but one clock
+        # of the MAC latency, the other overlaps with SAVE.
+        # The folded pre-add needs an extra bit on the sample side, and so a product one bit
+        # wider. The MAC accumulator is widened to hold it when macc_width is 2*width, the
+        # sum wraps the same way in the low macc_width bits that make up self.accumulator.
+        a_width = self.width+1 if folded else self.width
+        self.mac = MAC(a_width=a_width, b_width=self.width,
+            acc_width=max(self.macc_width, a_width+self.width), a_stages=mac_stages[0], b_stages=mac_stages[1],
+            m_stages=mac_stages[2], p_stages=mac_stages[3], fabric=fabric_multiply)
+        self.clear_cycles = max(1, self.mac.latency-1)
+        # min. number of clock cycles per sample, WAIT, LOAD, PROCESSING, PIPELINE_CLEAR and SAVE.
+        # Same meaning as FIR_Systolic's and the polyphase filters' latency: period == latency works.
+        self.latency = self.macs + self.clear_cycles + 3
 
         self.input = Signal(shape = self.sample) 
         self.input_ready_i = Signal()
@@ -33,70 +109,143 @@ class FIR_Pipelined(Elaboratable):
         self.output_ready_o = Signal()  
         self.accumulator = Signal(shape = Shape(width=self.macc_width, signed=True))      
 
+        # Optional port to reload the coefficients at runtime, as integers where 2**(width-1)
+        # is 1.0. Folded filters only store the first macs. Writes while a sample is being
+        # processed will corrupt that output.
+        self.coefficient_write = coefficient_write
+        if coefficient_write:
+            self.coefficient_i = Signal(shape = self.sample)
+            self.coefficient_address_i = Signal(range(self.macs))
+            self.coefficient_write_i = Signal()
+
     def elaborate(self, platform):
         m = Module()
 
-        sample_count = Signal(math.ceil(math.log2(self.taps)))
+        # Must be able to count past the last tap, to the zero coefficient
+        sample_count = Signal(range(self.macs+1))
+        clear_count = Signal(range(self.clear_cycles))
         reset_acc = Signal()
-        multiplicand1 = Signal(shape = self.sample) 
+        loading = Signal()
+        fir_waiting = Signal()
+        multiplicand1 = Signal(shape = signed(self.width+1) if self.folded else self.sample) 
         multiplicand2 = Signal(shape = self.sample) 
 
+        # Circular delay line, one write per sample so it maps onto block or distributed RAM.
+        # write_pointer is the newest sample, tap n is n places behind it.
         samples = Memory(width=self.width, depth=self.taps, 
             name = "samples")
+        m.submodules.sample_write = sample_write = samples.write_port()
+        m.submodules.sample_read = sample_read = samples.read_port(transparent=True)
+        write_pointer = Signal(range(self.taps))
+
+        # Reads are registered, so address tap sample_count+1 while tap sample_count is
+        # multiplied. LOAD addresses tap 0 as it is written.
+        read_tap = Signal(range(self.taps+2))
+        m.d.comb += read_tap.eq(Mux(loading, 0, sample_count+1))
+
+        # Coefficients in block RAM, with the data output register for Fmax, so they are
+        # addressed two taps ahead. The zero after the last one clears the pipeline.
+        coefficient_latency = 2
+        coefficient_tap = Signal(range(self.macs+coefficient_latency+1))
+        coefficient_init = [c % 2**self.width for c in self.coefficients[0:self.macs]] + [0]
+        m.d.comb += coefficient_tap.eq(Mux(loading, coefficient_latency-1,
+            sample_count+coefficient_latency))
+        with m.If(fir_waiting):
+            m.d.comb += coefficient_tap.eq(0)
+        if (platform != None) and (not self.coefficient_write) and (self.width <= 16):
+            from utility.bram_inst import BROMWrapper, generate_init_data
+            m.submodules.coefficient_rom = brom = BROMWrapper(generate_init_data(16,
+                self.coefficients[0:self.macs] + [0], signed_output=True))
+            m.d.comb += [
+                brom.address.eq(coefficient_tap),
+                multiplicand2.eq(brom.read_port[0:self.width]),
+            ]
+        else:
+            coefficients = Memory(width=self.width, depth=self.macs+1, init=coefficient_init,
+                name = "coefficients")
+            m.submodules.coefficient_read = coefficient_read = coefficients.read_port(transparent=False)
+            m.d.comb += coefficient_read.addr.eq(coefficient_tap)
+            m.d.sync += multiplicand2.eq(coefficient_read.data)
+            if self.coefficient_write:
+                m.submodules.coefficient_write = coefficient_write = coefficients.write_port()
+                m.d.comb += [
+                    coefficient_write.addr.eq(self.coefficient_address_i),
+                    coefficient_write.data.eq(self.coefficient_i),
+                    coefficient_write.en.eq(self.coefficient_write_i &
+                        (self.coefficient_address_i < self.macs)),
+                ]
+
+        def tap_address(tap):
+            return Mux(tap > write_pointer, write_pointer + self.taps - tap, write_pointer - tap)
 
         m.d.comb += [
-            multiplicand1.eq(samples[sample_count]),
-            reset_acc.eq(0)
+            reset_acc.eq(0),
+            loading.eq(0),
+            fir_waiting.eq(0),
+            sample_read.addr.eq(tap_address(read_tap)),
+            sample_write.addr.eq(write_pointer),
+            sample_write.data.eq(self.input),
         ]
         m.d.sync += self.output_ready_o.eq(0)
 
-        with m.Switch(sample_count):
-            for n in range(0, self.taps+1):
-                with m.Case(n):
-                    m.d.comb += multiplicand2.eq(self.coefficients[n])
+        if not self.folded:
+            m.d.comb += multiplicand1.eq(sample_read.data)
+        else:
+            # The partner of tap n is tap taps-1-n, n+1 places ahead of the newest sample.
+            # Memory contents are unsigned, so cast before the pre-add.
+            m.submodules.mirror_read = mirror_read = samples.read_port(transparent=True)
+            mirror_address = write_pointer + read_tap + 1
+            m.d.comb += mirror_read.addr.eq(Mux(mirror_address >= self.taps,
+                mirror_address - self.taps, mirror_address))
+            mirror = mirror_read.data.as_signed()
+            if self.taps % 2:
+                # Odd length, the centre tap has no partner
+                mirror = Mux(sample_count == self.macs-1, 0, mirror)
+            m.d.comb += multiplicand1.eq(sample_read.data.as_signed() + mirror)
 
         accumulator = self.accumulator 
-        fabric_multiply = False 
-        if ((platform == None) or fabric_multiply):
-            m.d.sync += accumulator.eq(accumulator + (multiplicand1*multiplicand2))
-            with m.If(reset_acc):
-                m.d.sync += accumulator.eq(0)
-        else:
-            with open('inferred_mult.v') as f:
-                platform.add_file('inferred_mult.v', f)
-            m.submodules.dsp = Instance(
-                'dsp48e_macc_latency1_16bit',
-                i_clk = ClockSignal(),
-                i_rst_sync = reset_acc,
-                i_a = multiplicand1,
-                i_b = multiplicand2,
-                o_accumulator = accumulator
-            )
+        m.submodules.mac = mac = self.mac
+        m.d.comb += [
+            mac.a.eq(multiplicand1),
+            mac.b.eq(multiplicand2),
+            mac.rst_sync.eq(reset_acc),
+            accumulator.eq(mac.accumulator),
+        ]
 
         with m.FSM() as fir_fsm:
             with m.State("WAIT"):
                 m.next = "WAIT"
-                m.d.comb += reset_acc.eq(1) 
+                m.d.comb += [
+                    reset_acc.eq(1),
+                    fir_waiting.eq(1),
+                ]
                 with m.If(self.input_ready_i):
                     m.next = "LOAD"           
+                    m.d.sync += write_pointer.eq(Mux(write_pointer == self.taps-1, 0, write_pointer+1))
 
             with m.State("LOAD"):
                 m.next = "PROCESSING"
-                m.d.sync += samples[0].eq(self.input)  
-                for i in range(1, self.taps):
-                        m.d.sync += samples[i].eq(samples[i-1])
-                m.d.comb += reset_acc.eq(1)                                 
+                m.d.comb += [
+                    sample_write.en.eq(1),
+                    loading.eq(1),
+                    reset_acc.eq(1),
+                ]
 
             with m.State("PROCESSING"):
                 m.next = "PROCESSING"
                 m.d.sync += sample_count.eq(sample_count+1) 
-                with m.If(sample_count==(self.taps-1)):
+                with m.If(sample_count==(self.macs-1)):
                     m.next = "PIPELINE_CLEAR"
             
             with m.State("PIPELINE_CLEAR"):
                 # wait as many clock cycles as needed for the pipeline in DSP to finish then
-                m.d.sync += sample_count.eq(0)
-                m.next = "SAVE"
+                m.d.sync += clear_count.eq(clear_count+1)
+                with m.If(clear_count == self.clear_cycles-1):
+                    m.d.sync += [
+                        sample_count.eq(0),
+                        clear_count.eq(0),
+                    ]
+                    m.next = "SAVE"
 
             with m.State("SAVE"):
                 m.next = "WAIT"
@@ -107,10 +256,47 @@ class FIR_Pipelined(Elaboratable):
 
         return m
 
+    def model(self, inputs):
+        # Bit-exact outputs for a stream of inputs, one per input_ready_i, starting from an
+        # empty delay line. Folding and the MAC pipeline do not change the result.
+        return fir_model(self.coefficients[0:self.taps], inputs, self.width, self.output_width,
+            self.macc_width)
+
 if __name__=="__main__":
 
     freq_response = False
-    
+
+    # Estimated delay line cost, worked out from the widths rather than taken from a
+    # synthesis report. Shifting every tap in LOAD kept the samples in flip-flops behind a
+    # taps:1 read mux. The circular buffer moves them into a single RAM with one write per
+    # sample (distributed RAM up to 64 deep, 18Kb block RAMs beyond that on Virtex-5). Its
+    # flip-flops are the write pointer, plus the registered read address for distributed
+    # RAM (block RAM registers it inside). The sample and clear counters are needed either way.
+    print("Estimated delay line cost at 16 bits, not from synthesis")
+    print("Taps, shift register flip-flops, circular buffer flip-flops, RAM bits, 18Kb BRAMs")
+    for taps in [16, 33, 128, 256, 512]:
+        bits = taps*16
+        pointer_bits = len(Signal(range(taps)))
+        brams = 0 if taps <= 64 else math.ceil(bits/18432)
+        flip_flops = pointer_bits if brams else 2*pointer_bits
+        print(str(taps) + ", " + str(bits) + ", " + str(flip_flops) + ", " + str(bits) + ", " +
+            str(brams))
+
+    # The NumPy model against the simulator, then its speed on a long random stream
+    import time
+    rng = np.random.default_rng()
+    dut = FIR_Pipelined(width=16, taps=33, macc_width=48, output_width=12)
+    inputs = rng.integers(-2**15, 2**15, 300)
+    outputs = simulate(dut, inputs, dut.latency)
+    print("Model matches simulation:", outputs == dut.model(inputs).tolist(), len(outputs), "outputs")
+    folded = FIR_Pipelined(folded=True)
+    outputs = simulate(folded, inputs, folded.latency)
+    print("Folded with default arguments matches model:", outputs == folded.model(inputs).tolist())
+    inputs = rng.integers(-2**15, 2**15, 10**7)
+    start = time.perf_counter()
+    dut.model(inputs)
+    print("Model:", round(len(inputs)/(time.perf_counter()-start)/1e6, 1), "million samples/s")
+
     def clock():
         while True:
             yield
@@ -168,56 +354,9 @@ if __name__=="__main__":
             sim.run_until(5e-5, run_passive=True)
     
     else:
-        
-        fir_taps = 33
-        # frequency is (w/pi)*1000 kHz
-        # max w is pi. (represents nyquist rate)
-        omega = 0.2
-        def freq_tb():
-            yield dut.input.eq(0)
-            yield dut.output.eq(0)
-            yield
-            for t in range(0,1000):      #100 samples with a 50 clock cycle sampling period 
-                yield dut.input_ready_i.eq(1)    # (500ns, 2MHz sample rate)            
-                yield dut.input.eq(round(math.sin(omega*t)*(2**17 -1)))
-                yield
-                yield dut.input_ready_i.eq(0)
-                for n in range(0, 49):
-                    yield
-
-        max_output = 0
-        def find_max_out():
-            global max_output
-            max_output = 0
-            for n in range(0, 50*fir_taps): # let the transient settle
-                    yield
-            while True:
-                out = yield dut.output
-                if(abs(out) > max_output):
-                    max_output = abs(out)
-                for n in range(0, 40):
-                    yield
-        
-        # fs/2 = 1000kHz
-        dut = FIR_Pipelined(width=18, macc_width=48,
-        taps=33, cutoff=0.001, filter_type='highpass')
-
-        def find_gain(frequency):
-            global omega
-            omega = (frequency*3.14)/1000
-            sweep = Simulator(dut)
-            sweep.add_clock(10e-9) #100MHz
-            sweep.add_sync_process(clock)
-            sweep.add_sync_process(find_max_out) 
-            sweep.add_sync_process(freq_tb)       
-            sweep.run_until(5e-5, run_passive=True)
-            return max_output/(2**17-1)
-
-        with open("frequency_sweep.csv", "w") as gains_out:
-            gains_out.write('Freq (kHz), Gain, Gain(dB) \n')
-            for decade in range(0, 3):
-                for step in range(1, 20):
-                    f = 0.5*step*(10**decade)
-                    gain = str(find_gain(f))
-                    gains_out.write(str(f) + ',' + gain + '\n')
-
+        # fs/2 = 1000kHz. The sweep runs in parallel, fitting a sine to the output
+        from fir_sweep import sweep, write_csv
+        frequencies = [0.5*step*(10**decade) for decade in range(0, 3) for step in range(1, 20)]
+        gains = sweep(dict(width=18, macc_width=48, taps=33, cutoff=0.001, filter_type='highpass'),
+            frequencies, 2000)
+        write_csv("frequency_sweep.csv", frequencies, gains)
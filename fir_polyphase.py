@@ -0,0 +1,250 @@
+from nmigen import *
+from nmigen.sim import *
+import math
+
+from fir_pipelined import gen_coefficients
+
+class FIR_Decimator(Elaboratable):
+    # Lowpass and keep one output in M, computing only the kept outputs with a single MAC.
+    # The taps multiplies for an output are spread over the following M input periods, so
+    # inputs can arrive as often as every ceil((taps+2)/M) clocks. The delay line is a
+    # circular buffer M-1 samples longer than the filter, so the inputs that arrive
+    # mid-calculation do not disturb it, which is the polyphase split done in time.
+    def __init__(self, M, width = 16, taps=32, cutoff=None, filter_type='lowpass',
+        output_width = None, macc_width=32):
+        if M < 2:
+            raise ValueError('Decimation ratio must be at least 2')
+        if(width*2 > macc_width):
+            raise ValueError('MACC width must be at least 2*sample width')
+
+        self.coefficients = gen_coefficients(width, taps, cutoff if cutoff else 1/M, filter_type)
+
+        if output_width == None:
+            self.output_width = width
+        else:
+            self.output_width = output_width
+        self.M = M
+        self.macc_width = macc_width
+        self.width = width
+        self.sample = Shape(width=self.width, signed=True)
+        self.taps = taps
+        self.latency = math.ceil((taps+2)/M)    # min. number of clock cycles per input sample
+
+        self.input = Signal(shape = self.sample)
+        self.input_ready_i = Signal()
+        self.output = Signal(signed(self.output_width))
+        self.output_ready_o = Signal()
+        self.accumulator = Signal(shape = Shape(width=self.macc_width, signed=True))
+
+    def elaborate(self, platform):
+        m = Module()
+
+        # Circular delay line, M-1 samples longer than the filter. Each calculation counts
+        # back from the sample that started it, so inputs that arrive mid-calculation go
+        # into newer places and leave the samples it is reading alone. Memory contents are
+        # unsigned, so store the coefficients as two's complement.
+        depth = self.taps+self.M-1
+        samples = Memory(width=self.width, depth=depth, name="samples")
+        coefficients = Memory(width=self.width, depth=self.taps, name="coefficients",
+            init=[c % 2**self.width for c in self.coefficients])
+        m.submodules.sample_write = sample_write = samples.write_port()
+        m.submodules.sample_read = sample_read = samples.read_port(transparent=False)
+        m.submodules.coefficient_read = coefficient_read = coefficients.read_port(transparent=False)
+
+        write_pointer = Signal(range(depth))
+        start = Signal(range(depth))    # where the newest sample of this calculation went
+        phase = Signal(range(self.M))
+        tap = Signal(range(self.taps))
+        busy = Signal()
+        done = Signal()
+
+        m.d.comb += [
+            sample_write.addr.eq(write_pointer),
+            sample_write.data.eq(self.input),
+            sample_write.en.eq(self.input_ready_i),
+            sample_read.addr.eq(Mux(tap > start, start + depth - tap, start - tap)),
+            coefficient_read.addr.eq(tap),
+        ]
+        with m.If(self.input_ready_i):
+            m.d.sync += write_pointer.eq(Mux(write_pointer == depth-1, 0, write_pointer+1))
+
+        # Read data arrives the clock after the address, first, valid and last follow it
+        first = Signal()
+        valid = Signal()
+        last = Signal()
+        m.d.sync += [
+            first.eq(busy & (tap == 0)),
+            valid.eq(busy),
+            last.eq(busy & (tap == self.taps-1)),
+            done.eq(valid & last),
+            self.output_ready_o.eq(0),
+        ]
+
+        accumulator = self.accumulator
+        product = sample_read.data.as_signed()*coefficient_read.data.as_signed()
+        with m.If(first):
+            m.d.sync += accumulator.eq(product)
+        with m.Elif(valid):
+            m.d.sync += accumulator.eq(accumulator + product)
+
+        with m.If(self.input_ready_i):
+            with m.If(phase == self.M-1):
+                m.d.sync += [
+                    phase.eq(0),
+                    start.eq(write_pointer),
+                    tap.eq(0),
+                    busy.eq(1),
+                ]
+            with m.Else():
+                m.d.sync += phase.eq(phase+1)
+
+        with m.If(busy):
+            m.d.sync += tap.eq(tap+1)
+            with m.If(tap == self.taps-1):
+                m.d.sync += busy.eq(0)
+
+        with m.If(done):
+            m.d.sync += [
+                self.output_ready_o.eq(1),
+                self.output.eq(accumulator[(2*self.width)-self.output_width:2*self.width]),
+            ]
+
+        return m
+
+class FIR_Interpolator(Elaboratable):
+    # Upsample by L without multiplying the stuffed zeros: output phase p only uses the
+    # coefficients p, p+L, p+2L... against the last ceil(taps/L) real inputs, so each input
+    # costs taps multiplies in total rather than L*taps. The L outputs come out in a burst,
+    # ceil(taps/L) clocks apart. The output is shifted up by log2(L) bits to make up for the
+    # stuffed zeros, which restores FIR_Pipelined's gain when L is a power of two.
+    def __init__(self, L, width = 16, taps=32, cutoff=None, filter_type='lowpass',
+        output_width = None, macc_width=32):
+        if L < 2:
+            raise ValueError('Interpolation ratio must be at least 2')
+        if(width*2 > macc_width):
+            raise ValueError('MACC width must be at least 2*sample width')
+
+        self.coefficients = gen_coefficients(width, taps, cutoff if cutoff else 1/L, filter_type)
+
+        if output_width == None:
+            self.output_width = width
+        else:
+            self.output_width = output_width
+        self.L = L
+        self.macc_width = macc_width
+        self.width = width
+        self.sample = Shape(width=self.width, signed=True)
+        self.taps = taps
+        self.phase_taps = math.ceil(taps/L)
+        self.gain_shift = int(math.log2(L))
+        self.latency = L*self.phase_taps + 2    # min. number of clock cycles per input sample
+
+        self.input = Signal(shape = self.sample)
+        self.input_ready_i = Signal()
+        self.output = Signal(signed(self.output_width))
+        self.output_ready_o = Signal()
+        self.accumulator = Signal(shape = Shape(width=self.macc_width, signed=True))
+
+    def elaborate(self, platform):
+        m = Module()
+
+        # Circular delay line of the last phase_taps inputs, counting back from the newest.
+        # Coefficients are addressed by Cat(tap, phase), phase p tap k holds coefficient
+        # k*L+p. Memory contents are unsigned, so store them as two's complement.
+        depth = self.phase_taps
+        padded = self.coefficients + [0]*(self.L*self.phase_taps - self.taps)
+        phase = Signal(range(self.L))
+        tap = Signal(range(self.phase_taps))
+        tap_span = 2**len(tap)
+        samples = Memory(width=self.width, depth=depth, name="samples")
+        coefficients = Memory(width=self.width, depth=self.L*tap_span, name="coefficients",
+            init=[(padded[k*self.L + p] if k < self.phase_taps else 0) % 2**self.width
+                for p in range(0, self.L) for k in range(0, tap_span)])
+        m.submodules.sample_write = sample_write = samples.write_port()
+        m.submodules.sample_read = sample_read = samples.read_port(transparent=False)
+        m.submodules.coefficient_read = coefficient_read = coefficients.read_port(transparent=False)
+
+        write_pointer = Signal(range(depth))
+        start = Signal(range(depth))    # where the newest sample went
+        busy = Signal()
+        done = Signal()
+
+        m.d.comb += [
+            sample_write.addr.eq(write_pointer),
+            sample_write.data.eq(self.input),
+            sample_write.en.eq(self.input_ready_i),
+            sample_read.addr.eq(Mux(tap > start, start + depth - tap, start - tap)),
+            coefficient_read.addr.eq(Cat(tap, phase)),
+        ]
+
+        # Read data arrives the clock after the address, first, valid and last follow it.
+        # Each phase starts its sum afresh, the finished one is picked up by done.
+        first = Signal()
+        valid = Signal()
+        last = Signal()
+        m.d.sync += [
+            first.eq(busy & (tap == 0)),
+            valid.eq(busy),
+            last.eq(busy & (tap == self.phase_taps-1)),
+            done.eq(valid & last),
+            self.output_ready_o.eq(0),
+        ]
+
+        accumulator = self.accumulator
+        product = sample_read.data.as_signed()*coefficient_read.data.as_signed()
+        with m.If(first):
+            m.d.sync += accumulator.eq(product)
+        with m.Elif(valid):
+            m.d.sync += accumulator.eq(accumulator + product)
+
+        with m.If(self.input_ready_i):
+            m.d.sync += [
+                write_pointer.eq(Mux(write_pointer == depth-1, 0, write_pointer+1)),
+                start.eq(write_pointer),
+                phase.eq(0),
+                tap.eq(0),
+                busy.eq(1),
+            ]
+        with m.Elif(busy):
+            with m.If(tap == self.phase_taps-1):
+                m.d.sync += [
+                    tap.eq(0),
+                    phase.eq(phase+1),
+                ]
+                with m.If(phase == self.L-1):
+                    m.d.sync += busy.eq(0)
+            with m.Else():
+                m.d.sync += tap.eq(tap+1)
+
+        top = 2*self.width - self.gain_shift
+        with m.If(done):
+            m.d.sync += [
+                self.output_ready_o.eq(1),
+                self.output.eq(accumulator[top-self.output_width:top]),
+            ]
+
+        return m
+
+if __name__=="__main__":
+
+    # Check both against a straightforward model: filter at the high rate then decimate,
+    # or zero stuff then filter
+    from fir_pipelined import fir_model, simulate
+    import random
+
+    inputs = [random.randint(-2**15, 2**15-1) for n in range(0, 120)]
+    for M in [2, 4, 5]:
+        dut = FIR_Decimator(M, width=16, taps=32, macc_width=48)
+        expected = fir_model(dut.coefficients, inputs, 16, 16, 48)[M-1::M].tolist()
+        print("Decimate by", M, "with input every", dut.latency, "clocks, matches:",
+            simulate(dut, inputs, dut.latency) == expected)
+
+    inputs = inputs[0:30]
+    for L in [2, 4, 5]:
+        dut = FIR_Interpolator(L, width=16, taps=32, macc_width=48)
+        stuffed = []
+        for sample in inputs:
+            stuffed += [sample] + [0]*(L-1)
+        expected = fir_model(dut.coefficients, stuffed, 16, 16, 48, dut.gain_shift).tolist()
+        print("Interpolate by", L, "with input every", dut.latency, "clocks, matches:",
+            simulate(dut, inputs, dut.latency) == expected)
@@ -0,0 +1,53 @@
+import math
+import sys
+import time
+import numpy as np
+from scipy import signal
+
+from fir_pipelined import FIR_Pipelined
+from fir_sweep import sweep, write_csv
+
+# Frequency response straight from the quantized FIR_Pipelined coefficients. The output
+# slice divides the accumulator by 2**width, so the gain includes the same factor of 0.5
+# the simulator sweeps measure. Coefficient quantization is included, output rounding
+# (a noise floor at about 2**-output_width) is not.
+
+def scaled_coefficients(fir_args):
+    # The filter's integer coefficients over the 2**width of the output slice
+    fir = FIR_Pipelined(**fir_args)
+    return np.array(fir.coefficients[0:fir.taps], dtype=np.float64)/2**fir.width
+
+def analytic_response(fir_args, sample_rate, points=4096):
+    # Gains at points frequencies from 0 up to (not including) sample_rate/2
+    frequencies, response = signal.freqz(scaled_coefficients(fir_args), worN=points, fs=sample_rate)
+    return frequencies, np.abs(response)
+
+def spot_check(fir_args, frequencies, sample_rate, **gain_args):
+    # Simulated against analytic gain at a few frequencies.
+    # Returns (frequency, analytic gain, simulated gain, difference in dB) for each. Gains
+    # are floored at 1e-12 so a null in either one gives a large difference, not an error.
+    _, response = signal.freqz(scaled_coefficients(fir_args), worN=frequencies, fs=sample_rate)
+    simulated = sweep(fir_args, frequencies, sample_rate, **gain_args)
+    checks = []
+    for f, analytic, measured in zip(frequencies, np.abs(response), simulated):
+        difference = 20*math.log10(max(measured, 1e-12)/max(analytic, 1e-12))
+        checks.append((f, float(analytic), measured, difference))
+    return checks
+
+if __name__=="__main__":
+
+    # The 33 tap highpass from fir_pipelined.py's sweep, 2MHz sample rate in kHz
+    fir_args = dict(width=18, macc_width=48, taps=33, cutoff=0.001, filter_type='highpass')
+    sample_rate = 2000
+    filename = sys.argv[1] if len(sys.argv) > 1 else "frequency_response.csv"
+
+    start = time.perf_counter()
+    frequencies, gains = analytic_response(fir_args, sample_rate)
+    write_csv(filename, frequencies, gains)
+    print(len(frequencies), "points in", round(1000*(time.perf_counter()-start), 1),
+        "ms, written to", filename)
+
+    print("Freq (kHz), analytic gain, simulated gain, difference (dB)")
+    for f, analytic, simulated, difference in spot_check(fir_args, [1, 100, 500, 900], sample_rate):
+        print(str(f) + ", " + str(round(analytic, 5)) + ", " + str(round(simulated, 5)) + ", " +
+            str(round(difference, 3)))
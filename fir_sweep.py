@@ -0,0 +1,99 @@
+from nmigen.sim import *
+import math
+import os
+import sys
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+from fir_pipelined import FIR_Pipelined
+from spectrum import fit_sine
+
+# Frequency sweep of FIR_Pipelined in the simulator, one tone per job in a process pool.
+# Each worker builds its own filter from fir_args once, in sweep_init, so nothing is shared
+# between processes. The gain is the least squares sine fit of the settled output over the
+# input amplitude, which is not thrown off by noise or quantization the way the peak is.
+# Gains are raw, so include FIR_Pipelined's factor of 0.5.
+
+worker_fir = None
+
+def sweep_init(fir_args):
+    global worker_fir
+    worker_fir = FIR_Pipelined(**fir_args)
+
+def fit_samples(frequency, min_samples=32, max_samples=128):
+    # Fewest samples from min_samples up that hold a whole number of cycles, so the sine fit
+    # is well conditioned, or max_samples for tones too slow to fit a cycle in
+    if frequency*max_samples < 1:
+        return max_samples
+    cycles = math.ceil(min_samples*frequency)
+    return min(max_samples, max(min_samples, round(cycles/frequency)))
+
+def simulate_held(fir, inputs):
+    # Outputs of fir for inputs at its fastest rate, with input_ready_i held high so it takes
+    # a new input every fir.latency clocks. The testbench only wakes once per sample, at the
+    # falling edge just before the input is captured, and the previous output is ready by then.
+    # Each wake up and each command costs more simulator time than a clock of the filter.
+    outputs = []
+
+    def tb():
+        yield fir.input_ready_i.eq(1)
+        for sample in inputs:
+            yield fir.input.eq(int(sample))
+            yield Delay(fir.latency*10e-9)
+            outputs.append((yield fir.output))
+
+    sim = Simulator(fir)
+    sim.add_clock(10e-9) #100MHz
+    sim.add_process(tb)
+    sim.run()
+    return outputs
+
+def measure_gain(frequency, min_samples=32, max_samples=128, amplitude=1.0):
+    # frequency in cycles per sample, 0 to 0.5. Inputs are fed at the fastest rate the
+    # filter accepts, which gives the same outputs as any slower sample clock. Output
+    # taps-1 is the first with no zeros left in the delay line.
+    fir = worker_fir
+    settle = fir.taps-1
+    samples = fit_samples(frequency, min_samples, max_samples)
+    full_scale = amplitude*(2**(fir.width-1)-1)
+    inputs = [round(full_scale*math.sin(2*math.pi*frequency*n)) for n in range(0, settle+samples)]
+    outputs = simulate_held(fir, inputs)
+
+    # Output is output_width bits, scale back to the input's full scale
+    scale = 2**(fir.width-fir.output_width)
+    output_amplitude, phase, offset, residual = fit_sine(np.array(outputs[settle:])*scale, frequency)
+    return float(output_amplitude/full_scale)
+
+def sweep(fir_args, frequencies, sample_rate, processes=None, **gain_args):
+    # frequencies and sample_rate in the same units, returns the gains in order
+    with ProcessPoolExecutor(max_workers=processes, initializer=sweep_init,
+            initargs=(fir_args,)) as pool:
+        jobs = [pool.submit(measure_gain, f/sample_rate, **gain_args) for f in frequencies]
+        return [job.result() for job in jobs]
+
+def write_csv(filename, frequencies, gains, unit='kHz'):
+    with open(filename, "w") as gains_out:
+        gains_out.write('Freq (' + unit + '), Gain, Gain(dB)\n')
+        for f, gain in zip(frequencies, gains):
+            gain_db = 20*math.log10(gain) if gain > 0 else -math.inf
+            gains_out.write(str(f) + ',' + str(gain) + ',' + str(gain_db) + '\n')
+
+if __name__=="__main__":
+
+    # Same sweep as fir_pipelined.py used to run serially: 2MHz sample rate (a sample every
+    # 50 clocks at 100MHz), 0.5kHz to 950kHz
+    fir_args = dict(width=18, macc_width=48, taps=33, cutoff=0.001, filter_type='highpass')
+    sample_rate = 2000
+    frequencies = [0.5*step*(10**decade) for decade in range(0, 3) for step in range(1, 20)]
+    filename = sys.argv[1] if len(sys.argv) > 1 else "frequency_sweep.csv"
+
+    fir = FIR_Pipelined(**fir_args)
+    inputs = np.random.default_rng().integers(-2**17, 2**17, 100)
+    print("Held input testbench matches model:", simulate_held(fir, inputs) == fir.model(inputs).tolist())
+
+    start = time.perf_counter()
+    gains = sweep(fir_args, frequencies, sample_rate)
+    write_csv(filename, frequencies, gains)
+    print(len(frequencies), "frequencies on", os.cpu_count(), "cores in",
+        round(time.perf_counter()-start, 1), "s, written to", filename)
@@ -0,0 +1,124 @@
+from nmigen import *
+from nmigen.sim import *
+import math
+
+from fir_pipelined import gen_coefficients
+
+class FIR_Systolic(Elaboratable):
+    # Same coefficients and ports as FIR_Pipelined, but with macs multipliers working in
+    # parallel as a transposed chain. Each new sample is broadcast to every MAC, and every tap
+    # keeps a partial sum that adds its product to the next tap's sum from the sample before,
+    # so partial sums flow down the chain from MAC to MAC (DSP48 PCIN/PCOUT style) and there
+    # is no adder tree. Each MAC owns a contiguous slice of ceil(taps/macs) taps and steps
+    # through it; macs=taps takes a new sample every clock, macs=1 is one MAC in a loop.
+    def __init__(self, width = 16, taps=16, cutoff=0.5, filter_type='lowpass',
+        output_width = None, macc_width=32, macs=None):
+
+        self.coefficients = gen_coefficients(width, taps, cutoff, filter_type)
+
+        if(width*2 > macc_width):
+            raise ValueError('MACC width must be at least 2*sample width')
+        if output_width == None:
+            self.output_width = width
+        else:
+            self.output_width = output_width
+        self.macc_width = macc_width
+        self.width = width
+        self.sample = Shape(width=self.width, signed=True)
+        self.taps = taps
+
+        self.macs = macs if macs else taps
+        if not (1 <= self.macs <= taps):
+            raise ValueError('Number of MACs must be between 1 and the number of taps')
+        self.taps_per_mac = math.ceil(taps/self.macs)
+        self.latency = self.taps_per_mac   # min. number of clock cycles per sample
+        # input_ready_i to output_ready_o, the first tap's sum is complete after one step
+        self.pipeline_delay = 4
+
+        self.input = Signal(shape = self.sample)
+        self.input_ready_i = Signal()
+        self.output = Signal(signed(self.output_width))
+        self.output_ready_o = Signal()
+
+    def elaborate(self, platform):
+        m = Module()
+
+        length = self.taps_per_mac
+        acc_shape = Shape(width=self.macc_width, signed=True)
+
+        # The sample being worked on, held for every MAC
+        sample = Signal(self.sample)
+        with m.If(self.input_ready_i):
+            m.d.sync += sample.eq(self.input)
+        padded_coefficients = self.coefficients + [0]*(self.macs*length - self.taps)
+
+        # Step through each MAC's slice after every new sample
+        count = Signal(range(length))
+        active = Signal()
+        with m.If(self.input_ready_i):
+            m.d.sync += [
+                count.eq(0),
+                active.eq(1),
+            ]
+        with m.Elif(count == length-1):
+            m.d.sync += active.eq(0)
+        with m.Else():
+            m.d.sync += count.eq(count+1)
+
+        # Multiplier output registers, then add in the partial sum coming down the chain
+        step = Signal(range(length))
+        valid = Signal()
+        m.d.sync += [
+            step.eq(count),
+            valid.eq(active),
+        ]
+        partials = [Signal(acc_shape, name="partial_"+str(n)) for n in range(0, self.macs*length)]
+        cascades = [Signal(acc_shape, name="cascade_"+str(p)) for p in range(0, self.macs)]
+        for p in range(0, self.macs):
+            coefficient = Array(Const(c, self.sample)
+                for c in padded_coefficients[p*length:(p+1)*length])[count]
+            product = Signal(acc_shape, name="product_"+str(p))
+            m.d.sync += product.eq(sample*coefficient)
+
+            # Taps are stepped in order, so the next tap in the lane still holds its sum from
+            # the sample before. The next MAC's first tap has been updated by the time the
+            # last tap here needs it, so it is passed on in a cascade register as it is read.
+            lane = partials[p*length:(p+1)*length]
+            if p == self.macs-1:
+                following = Const(0, acc_shape)
+            elif length == 1:
+                following = partials[(p+1)*length]
+            else:
+                following = cascades[p+1]
+                with m.If(valid & (step == 0)):
+                    m.d.sync += cascades[p+1].eq(partials[(p+1)*length])
+            incoming = Array(lane[1:] + [following])[step]
+            with m.If(valid):
+                m.d.sync += Array(lane)[step].eq(product + incoming)
+
+        # The first tap's sum is the output once the first step of the first MAC is done
+        done = Signal()
+        m.d.sync += done.eq(valid & (step == 0))
+        accumulator = partials[0]
+        m.d.sync += self.output_ready_o.eq(done)
+        with m.If(done):
+            m.d.sync += self.output.eq(accumulator[(2*self.width)-self.output_width:2*self.width])
+
+        return m
+
+if __name__=="__main__":
+
+    # Compare against FIR_Pipelined at a range of MAC counts
+    from fir_pipelined import FIR_Pipelined, simulate
+    import random
+
+    taps = 33
+    inputs = [random.randint(-2**15, 2**15-1) for n in range(0, 60)]
+
+    reference = FIR_Pipelined(width=16, taps=taps, macc_width=48)
+    expected = simulate(reference, inputs, reference.latency)
+    print("MACs, clocks per sample, delay, matches FIR_Pipelined")
+    for macs in [1, 4, 11, taps]:
+        dut = FIR_Systolic(width=16, taps=taps, macc_width=48, macs=macs)
+        print(str(macs) + ", " + str(dut.latency) + ", " + str(dut.pipeline_delay) + ", " +
+            str(simulate(dut, inputs, dut.latency) == expected))
@@ -1,28 +1,77 @@
-// Macc with registered inputs as per UG626
-// note that a faster version would also use
-// registers on the multiply output, for one extra latency cycle
+// Signed macc with selectable pipeline depths, DSP48 style:
+// AREG/BREG input registers, MREG multiply output registers and
+// PREG accumulator/output registers (at least 1). Operands presented
+// together need AREG == BREG. rst_sync travels down the pipeline with
+// the operands, so it clears the accumulator before the first product
+// presented after it is released. Latency from a/b to accumulator is
+// max(AREG, BREG) + MREG + PREG.
 
-module dsp48e_macc_latency1_16bit(
+module dsp48e_macc #(
+    parameter A_WIDTH = 16,
+    parameter B_WIDTH = 16,
+    parameter ACC_WIDTH = 32,
+    parameter AREG = 1,
+    parameter BREG = 1,
+    parameter MREG = 0,
+    parameter PREG = 1
+) (
     input clk, rst_sync,
-    input [15:0] a, b,
-    output [31:0] accumulator
+    input signed [A_WIDTH-1:0] a,
+    input signed [B_WIDTH-1:0] b,
+    output signed [ACC_WIDTH-1:0] accumulator
 );
 
-reg [31:0] acc_reg;
-reg [15:0] a_reg, b_reg;
+localparam RST_DELAY = (AREG > BREG ? AREG : BREG) + MREG;
 
-assign accumulator = acc_reg;
+wire signed [A_WIDTH-1:0] a_stage [0:AREG];
+wire signed [B_WIDTH-1:0] b_stage [0:BREG];
+wire signed [A_WIDTH+B_WIDTH-1:0] m_stage [0:MREG];
+wire rst_stage [0:RST_DELAY];
+wire signed [ACC_WIDTH-1:0] p_stage [0:PREG-1];
+
+assign a_stage[0] = a;
+assign b_stage[0] = b;
+assign m_stage[0] = a_stage[AREG]*b_stage[BREG];
+assign rst_stage[0] = rst_sync;
+assign accumulator = p_stage[PREG-1];
+
+genvar i;
+generate
+    for (i = 0; i < AREG; i = i+1) begin : a_regs
+        reg signed [A_WIDTH-1:0] a_reg = 0;
+        always @(posedge clk) a_reg <= a_stage[i];
+        assign a_stage[i+1] = a_reg;
+    end
+    for (i = 0; i < BREG; i = i+1) begin : b_regs
+        reg signed [B_WIDTH-1:0] b_reg = 0;
+        always @(posedge clk) b_reg <= b_stage[i];
+        assign b_stage[i+1] = b_reg;
+    end
+    for (i = 0; i < MREG; i = i+1) begin : m_regs
+        reg signed [A_WIDTH+B_WIDTH-1:0] m_reg = 0;
+        always @(posedge clk) m_reg <= m_stage[i];
+        assign m_stage[i+1] = m_reg;
+    end
+    for (i = 0; i < RST_DELAY; i = i+1) begin : rst_regs
+        reg rst_reg = 0;
+        always @(posedge clk) rst_reg <= rst_stage[i];
+        assign rst_stage[i+1] = rst_reg;
+    end
+    for (i = 1; i < PREG; i = i+1) begin : p_regs
+        reg signed [ACC_WIDTH-1:0] p_reg = 0;
+        always @(posedge clk) p_reg <= p_stage[i-1];
+        assign p_stage[i] = p_reg;
+    end
+endgenerate
+
+reg signed [ACC_WIDTH-1:0] acc_reg = 0;
+assign p_stage[0] = acc_reg;
 
 always @(posedge clk) begin
-    if(rst_sync) begin
+    if(rst_stage[RST_DELAY])
         acc_reg <= 0;
-        a_reg <= 0;
-        b_reg <= 0;
-    end else begin
-        a_reg <= a;
-        b_reg <= b;
-        acc_reg <= acc_reg + (a_reg*b_reg);
-    end
+    else
+        acc_reg <= acc_reg + m_stage[MREG];
 end
 
-endmodule
\ No newline at end of file
+endmodule
@@ -0,0 +1,110 @@
+from nmigen import *
+from nmigen.sim import *
+
+class MAC(Elaboratable):
+    # Signed multiply accumulate with DSP48 style pipeline registers: a_stages and b_stages
+    # on the operands, which must match as dsp48e_macc needs AREG == BREG, m_stages on the
+    # multiplier output and p_stages on the accumulator (the accumulator register itself,
+    # plus any output registers). rst_sync follows the operands down the pipeline, so it
+    # clears the accumulator before the first product presented after it is released.
+    # latency is from a and b to accumulator.
+    # On hardware this is dsp48e_macc in inferred_mult.v, fabric=True or simulation uses
+    # the same pipeline built from nMigen registers.
+    def __init__(self, a_width=16, b_width=16, acc_width=32, a_stages=1, b_stages=1,
+        m_stages=0, p_stages=1, fabric=False):
+        if min(a_stages, b_stages, m_stages) < 0 or p_stages < 1:
+            raise ValueError('Pipeline depths must be positive, with at least one accumulator register')
+        if a_stages != b_stages:
+            raise ValueError('Operand pipelines must be the same depth')
+        if acc_width < a_width + b_width:
+            raise ValueError('Accumulator must be at least as wide as the product')
+
+        self.a_width = a_width
+        self.b_width = b_width
+        self.acc_width = acc_width
+        self.a_stages = a_stages
+        self.b_stages = b_stages
+        self.m_stages = m_stages
+        self.p_stages = p_stages
+        self.fabric = fabric
+        self.latency = a_stages + m_stages + p_stages
+
+        self.a = Signal(signed(a_width))
+        self.b = Signal(signed(b_width))
+        self.rst_sync = Signal()
+        self.accumulator = Signal(signed(acc_width))
+
+    def elaborate(self, platform):
+        m = Module()
+
+        if (platform != None) and (not self.fabric):
+            with open('inferred_mult.v') as f:
+                platform.add_file('inferred_mult.v', f)
+            m.submodules.dsp = Instance(
+                'dsp48e_macc',
+                p_A_WIDTH = self.a_width,
+                p_B_WIDTH = self.b_width,
+                p_ACC_WIDTH = self.acc_width,
+                p_AREG = self.a_stages,
+                p_BREG = self.b_stages,
+                p_MREG = self.m_stages,
+                p_PREG = self.p_stages,
+                i_clk = ClockSignal(),
+                i_rst_sync = self.rst_sync,
+                i_a = self.a,
+                i_b = self.b,
+                o_accumulator = self.accumulator
+            )
+            return m
+
+        def delay(signal, stages, name):
+            for n in range(0, stages):
+                stage = Signal.like(signal, name=name+"_"+str(n))
+                m.d.sync += stage.eq(signal)
+                signal = stage
+            return signal
+
+        a = delay(self.a, self.a_stages, "a_reg")
+        b = delay(self.b, self.b_stages, "b_reg")
+        product = Signal(signed(self.a_width + self.b_width))
+        m.d.comb += product.eq(a*b)
+        product = delay(product, self.m_stages, "m_reg")
+        rst = delay(self.rst_sync, max(self.a_stages, self.b_stages) + self.m_stages, "rst_reg")
+
+        acc = Signal(signed(self.acc_width))
+        with m.If(rst):
+            m.d.sync += acc.eq(0)
+        with m.Else():
+            m.d.sync += acc.eq(acc + product)
+        m.d.comb += self.accumulator.eq(delay(acc, self.p_stages-1, "p_reg"))
+
+        return m
+
+if __name__=="__main__":
+
+    # Sum of products after releasing rst_sync should appear latency clocks after the last one
+    import random
+
+    for stages in [(0, 0, 0, 1), (1, 1, 0, 1), (1, 1, 1, 1), (2, 2, 1, 2)]:
+        dut = MAC(18, 25, 48, *stages)
+        a = [random.randint(-2**17, 2**17-1) for n in range(0, 20)]
+        b = [random.randint(-2**24, 2**24-1) for n in range(0, 20)]
+        results = []
+
+        def tb():
+            yield dut.rst_sync.eq(1)
+            yield
+            yield dut.rst_sync.eq(0)
+            for n in range(0, 20 + dut.latency):
+                yield dut.a.eq(a[n] if n < 20 else 0)
+                yield dut.b.eq(b[n] if n < 20 else 0)
+                yield
+                results.append((yield dut.accumulator))
+
+        sim = Simulator(dut)
+        sim.add_clock(10e-9) #100MHz
+        sim.add_sync_process(tb)
+        sim.run()
+        expected = sum(x*y for x, y in zip(a, b))
+        print("A/B/M/P stages", stages, "latency", dut.latency, "matches:",
+            (results[19 + dut.latency] == expected) and (results[18 + dut.latency] != expected))
@@ -0,0 +1,64 @@
+import sys
+import numpy as np
+
+from pdm import PDM
+from pwm import PWM
+from spectrum import inband_snr_db, thd_db, largest_spur_db
+
+# In-band SNR, THD and idle tones of PDM and PWM at a given resolution and oversampling
+# ratio, from the bit-exact NumPy models of the gateware rather than the simulator.
+# The band edge is clk/(2*osr). The test tone is a -6dBFS sine at a fifth of the band
+# edge, the idle tone input is one LSB above mid scale.
+# Usage: python modulator_benchmark.py [resolution] [osr] [log2 samples]
+
+clk_frequency = 100000000
+
+def tone_inputs(resolution, frequency, count, amplitude=0.5):
+    mid = 2**(resolution-1)
+    values = mid + amplitude*(mid-1)*np.sin(2*np.pi*frequency*np.arange(0, count))
+    return np.round(values).astype(np.int64)
+
+def measure(bits, frequency, osr, idle_bits):
+    snr = inband_snr_db(bits, frequency, osr)
+    thd = thd_db(bits, frequency, osr)
+    spur, spur_frequency = largest_spur_db(idle_bits, osr)
+    return snr, thd, spur, spur_frequency
+
+def report(name, results):
+    snr, thd, spur, spur_frequency = results
+    # A periodic idle pattern with all its lines above the band leaves only rounding error
+    if spur < -200:
+        idle = "none"
+    else:
+        idle = str(round(spur, 1)) + " at " + str(round(spur_frequency*clk_frequency/1e3, 1))
+    print(name + ", " + str(round(snr, 1)) + ", " + str(round(thd, 1)) + ", " + idle)
+
+if __name__ == "__main__":
+    resolution = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    osr = int(sys.argv[2]) if len(sys.argv) > 2 else 256
+    samples = 2**(int(sys.argv[3]) if len(sys.argv) > 3 else 22)
+    band_bins = samples//(2*osr)
+    frequency = round(band_bins/5)/samples
+
+    print(str(resolution) + " bit input, OSR " + str(osr) + ", band edge " +
+        str(round(clk_frequency/(2*osr)/1e3, 1)) + " kHz at " + str(clk_frequency/1e6) + " MHz clock, " +
+        str(samples) + " clocks")
+    print("Modulator, SNR (dB), THD (dB), largest idle tone (dBFS) at (kHz)")
+
+    # PDM takes a new input every clock
+    pdm = PDM(resolution)
+    idle = np.full(samples, 2**(resolution-1) + 1)
+    report("PDM", measure(pdm.model(tone_inputs(resolution, frequency, samples)), frequency, osr,
+        pdm.model(idle)))
+
+    # PWM takes a new input every period of 2**resolution clocks, its carrier has to be
+    # above the band
+    pwm = PWM(resolution)
+    period = 2**resolution
+    if period >= 2*osr:
+        print("PWM, carrier at " + str(round(clk_frequency/period/1e3, 1)) + " kHz is in band")
+        sys.exit()
+    periods = samples//period
+    values = tone_inputs(resolution, frequency*period, periods)
+    idle = np.full(periods, 2**(resolution-1) + 1)
+    report("PWM", measure(pwm.model(values), frequency, osr, pwm.model(idle)))
@@ -0,0 +1,123 @@
+from nmigen import *
+from nmigen.sim import *
+import math
+
+from nco_lut import *
+
+class NCO_Bank(Elaboratable):
+    # Many NCOs sharing one sine table. Phase accumulators and increments live in small RAMs
+    # and the channels are serviced round robin, one per clock, so each channel runs at
+    # clk/channels. Outputs are tagged with the channel they belong to.
+    def __init__(self, channels=32, output_width=8, sin_input_width=None, signed_output=True):
+        if channels < 2:
+            raise ValueError('Use NCO_LUT for a single channel')
+
+        self.phi_inc_i = Signal(31)
+        self.write_channel_i = Signal(range(channels))
+        self.write_enable_i = Signal()
+
+        self.signed_output = signed_output
+        if (signed_output):
+            self.sine_wave_o = Signal(shape=signed(output_width))
+        else:
+            self.sine_wave_o = Signal(shape=unsigned(output_width))
+        self.channel_o = Signal(range(channels))
+        self.valid_o = Signal()
+
+        self.channels = channels
+        self.output_width = output_width
+        if sin_input_width:
+            self.sin_input_width = sin_input_width
+        else:
+            self.sin_input_width = output_width
+        self.latency = 3    # channel selected to output
+
+    def elaborate(self, platform):
+        m = Module()
+
+        input_width = self.sin_input_width
+
+        phases = Memory(width=32, depth=self.channels, name="phases")
+        increments = Memory(width=31, depth=self.channels, name="increments")
+        table = Memory(width=self.output_width, depth=2**input_width, name="sine",
+            init=gen_table(input_width, self.output_width, self.signed_output).tolist())
+
+        m.submodules.phase_rd = phase_rd = phases.read_port()
+        m.submodules.phase_wr = phase_wr = phases.write_port()
+        m.submodules.inc_rd = inc_rd = increments.read_port()
+        m.submodules.inc_wr = inc_wr = increments.write_port()
+        m.submodules.table_rd = table_rd = table.read_port()
+
+        m.d.comb += [
+            inc_wr.addr.eq(self.write_channel_i),
+            inc_wr.data.eq(self.phi_inc_i),
+            inc_wr.en.eq(self.write_enable_i),
+        ]
+
+        # Stage 0: read the channel's phase and increment, stage 1: write back the
+        # updated phase and look up the current one, stage 2: register the output
+        channel = Signal(range(self.channels))
+        channel_1 = Signal(range(self.channels))
+        channel_2 = Signal(range(self.channels))
+        valid = Signal(2)
+
+        with m.If(channel == self.channels-1):
+            m.d.sync += channel.eq(0)
+        with m.Else():
+            m.d.sync += channel.eq(channel+1)
+        m.d.sync += [
+            channel_1.eq(channel),
+            channel_2.eq(channel_1),
+            valid.eq(Cat(1, valid[0])),
+        ]
+
+        m.d.comb += [
+            phase_rd.addr.eq(channel),
+            inc_rd.addr.eq(channel),
+            phase_wr.addr.eq(channel_1),
+            phase_wr.data.eq(phase_rd.data + inc_rd.data),
+            phase_wr.en.eq(valid[0]),
+            table_rd.addr.eq(phase_rd.data[32-input_width:32]),
+        ]
+
+        m.d.sync += [
+            self.sine_wave_o.eq(table_rd.data),
+            self.channel_o.eq(channel_2),
+            self.valid_o.eq(valid[1]),
+        ]
+
+        return m
+
+if __name__ == "__main__":
+
+    channels = 4
+    frames = 100
+    phi_incs = [calc_phi_inc(f, 100000000/channels) for f in [1e6, 2e6, 3.5e6, 5e6]]
+    dut = NCO_Bank(channels=channels, output_width=8)
+    outputs = [[] for c in range(0, channels)]
+
+    def tb():
+        yield dut.write_enable_i.eq(1)
+        for c in range(0, channels):
+            yield dut.write_channel_i.eq(c)
+            yield dut.phi_inc_i.eq(phi_incs[c])
+            yield
+        yield dut.write_enable_i.eq(0)
+        for n in range(0, channels*frames):
+            yield
+            if (yield dut.valid_o):
+                outputs[(yield dut.channel_o)].append((yield dut.sine_wave_o))
+
+    sim = Simulator(dut)
+    sim.add_clock(10e-9) #100MHz
+    sim.add_sync_process(tb)
+    sim.run()
+
+    # Each channel should step through the table at its own rate once its increment is written,
+    # the phases reset to 0 so skip the leading zeros before that
+    table = gen_table(dut.sin_input_width, dut.output_width)
+    for c in range(0, channels):
+        output = outputs[c][next(n for n, sample in enumerate(outputs[c]) if sample != 0):]
+        expected = [int(table[((n*phi_incs[c]) % 2**32) >> (32-dut.sin_input_width)])
+            for n in range(1, len(output)+1)]
+        print("Channel " + str(c) + ", " + str(len(output)) + " samples, matches:", output == expected)
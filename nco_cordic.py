@@ -0,0 +1,135 @@
+from nmigen import *
+from nmigen.sim import *
+import math
+
+from nco_lut import calc_phi_inc
+
+class NCO_CORDIC(Elaboratable):
+    # ROM-free sine/cosine, one rotation-mode CORDIC iteration per pipeline stage so the
+    # throughput is one sample per clock. Same phi_inc_i/sine_wave_o interface as NCO_LUT,
+    # plus cosine_wave_o in quadrature.
+    def __init__(self, output_width=16, iterations=None, signed_output=True):
+        self.phi_inc_i = Signal(31)
+
+        self.signed_output = signed_output
+        if (signed_output):
+            self.sine_wave_o = Signal(shape=signed(output_width))
+            self.cosine_wave_o = Signal(shape=signed(output_width))
+        else:
+            self.sine_wave_o = Signal(shape=unsigned(output_width))
+            self.cosine_wave_o = Signal(shape=unsigned(output_width))
+
+        self.output_width = output_width
+        if iterations:
+            self.iterations = iterations
+        else:
+            self.iterations = output_width
+        if self.iterations < 1:
+            raise ValueError('CORDIC needs at least one iteration')
+
+        self.guard_bits = math.ceil(math.log2(self.iterations)) + 1
+        self.angle_width = min(32, output_width + self.guard_bits + 2)
+        self.latency = self.iterations + 2  # phase register to output
+
+        # Angles are in units of a full circle = 2**angle_width
+        self.atan_table = [round((math.atan(2**-i)/(2*math.pi))*(2**self.angle_width))
+            for i in range(0, self.iterations)]
+        self.gain = 1
+        for i in range(0, self.iterations):
+            self.gain *= math.sqrt(1 + 2**(-2*i))
+
+    def elaborate(self, platform):
+        m = Module()
+
+        output_width = self.output_width
+        angle_width = self.angle_width
+        width = output_width + self.guard_bits + 1
+        amplitude = int((((2**(output_width-1))-1)*(2**self.guard_bits))/self.gain)
+
+        phi = Signal(32)
+        m.d.sync += phi.eq(phi + self.phi_inc_i)
+
+        phase = Signal(angle_width)
+        quadrant = Signal(2)
+        m.d.comb += [
+            phase.eq(phi[32-angle_width:32]),
+            quadrant.eq(phase[angle_width-2:angle_width]),
+        ]
+
+        # The quadrant is handled by starting from a vector already rotated by a multiple
+        # of pi/2, leaving a residual angle in [0, pi/2) which is within CORDIC range
+        x = [Signal(signed(width), name="x_"+str(i)) for i in range(0, self.iterations+1)]
+        y = [Signal(signed(width), name="y_"+str(i)) for i in range(0, self.iterations+1)]
+        z = [Signal(signed(angle_width), name="z_"+str(i)) for i in range(0, self.iterations+1)]
+
+        m.d.sync += z[0].eq(phase[0:angle_width-2])
+        with m.Switch(quadrant):
+            for q, (x_start, y_start) in enumerate([(1, 0), (0, 1), (-1, 0), (0, -1)]):
+                with m.Case(q):
+                    m.d.sync += [
+                        x[0].eq(x_start*amplitude),
+                        y[0].eq(y_start*amplitude),
+                    ]
+
+        for i in range(0, self.iterations):
+            with m.If(z[i] >= 0):
+                m.d.sync += [
+                    x[i+1].eq(x[i] - (y[i] >> i)),
+                    y[i+1].eq(y[i] + (x[i] >> i)),
+                    z[i+1].eq(z[i] - self.atan_table[i]),
+                ]
+            with m.Else():
+                m.d.sync += [
+                    x[i+1].eq(x[i] + (y[i] >> i)),
+                    y[i+1].eq(y[i] - (x[i] >> i)),
+                    z[i+1].eq(z[i] + self.atan_table[i]),
+                ]
+
+        # Round off the guard bits
+        sine = Signal(signed(width))
+        cosine = Signal(signed(width))
+        half = 1 << (self.guard_bits-1)
+        m.d.comb += [
+            sine.eq((y[-1] + half) >> self.guard_bits),
+            cosine.eq((x[-1] + half) >> self.guard_bits),
+        ]
+        if self.signed_output:
+            m.d.sync += [
+                self.sine_wave_o.eq(sine),
+                self.cosine_wave_o.eq(cosine),
+            ]
+        else:
+            # Flipping the MSB moves two's complement to offset binary
+            m.d.sync += [
+                self.sine_wave_o.eq(sine ^ (1 << (output_width-1))),
+                self.cosine_wave_o.eq(cosine ^ (1 << (output_width-1))),
+            ]
+
+        return m
+
+if __name__ == "__main__":
+
+    print("Iterations, output width, latency, max error (LSB)")
+    phi_inc = calc_phi_inc(1234567, 100000000)
+    for iterations in range(8, 19, 2):
+        dut = NCO_CORDIC(output_width=16, iterations=iterations)
+        sim = Simulator(dut)
+        sim.add_clock(10e-9) #100MHz
+        error = [0]
+
+        def tb():
+            yield dut.phi_inc_i.eq(phi_inc)
+            yield
+            for n in range(0, 500 + dut.latency):
+                if n >= dut.latency:
+                    phase = 2*math.pi*(((n-dut.latency)*phi_inc) % 2**32)/(2**32)
+                    amplitude = (2**15)-1
+                    error[0] = max(error[0],
+                        abs((yield dut.sine_wave_o) - amplitude*math.sin(phase)),
+                        abs((yield dut.cosine_wave_o) - amplitude*math.cos(phase)))
+                yield
+
+        sim.add_sync_process(tb)
+        sim.run()
+        print(str(iterations) + ", " + str(dut.output_width) + ", " + str(dut.latency) +
+            ", " + str(round(error[0], 2)))
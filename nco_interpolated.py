@@ -0,0 +1,146 @@
+from nmigen import *
+from nmigen.sim import *
+import math
+import numpy as np
+
+from nco_lut import calc_phi_inc, lut_size
+
+def gen_interpolation_table(input_width, output_width, guard_bits=2):
+    # Exactly periodic sine table (unlike gen_lookup) with guard bits, plus the difference
+    # to the next entry, which is what gets multiplied by the fractional phase
+    amplitude = ((2**(output_width-1))-1)*(2**guard_bits)
+    entries = np.arange(2**input_width, dtype=np.float64)
+    table = np.round(amplitude*np.sin(2.0*math.pi*entries/(2**input_width))).astype(np.int64)
+    delta = np.roll(table, -1) - table
+    return table, delta
+
+class NCO_Interpolated(Elaboratable):
+    # Linear interpolation between adjacent table entries using the phase bits NCO_LUT discards.
+    # The multiply has registered inputs and output so it maps onto a DSP slice, like inferred_mult.v
+    def __init__(self, output_width=16, sin_input_width=9, frac_width=16, signed_output=True, guard_bits=2):
+        if sin_input_width + frac_width > 32:
+            raise ValueError('sin_input_width + frac_width must fit in the 32 bit phase')
+
+        self.phi_inc_i = Signal(31)
+
+        self.signed_output = signed_output
+        if (signed_output):
+            self.sine_wave_o = Signal(shape=signed(output_width))
+        else:
+            self.sine_wave_o = Signal(shape=unsigned(output_width))
+
+        self.output_width = output_width
+        self.sin_input_width = sin_input_width
+        self.frac_width = frac_width
+        self.guard_bits = guard_bits
+        self.latency = 4    # phase register to output
+
+        self.table, self.delta = gen_interpolation_table(sin_input_width, output_width, guard_bits)
+        self.delta_width = max(abs(int(d)) for d in self.delta).bit_length() + 1
+
+    def elaborate(self, platform):
+        m = Module()
+
+        input_width = self.sin_input_width
+        frac_width = self.frac_width
+        sample_width = self.output_width + self.guard_bits
+        shift = frac_width + self.guard_bits
+
+        phi = Signal(32)
+        m.d.sync += phi.eq(phi + self.phi_inc_i)
+
+        table_entry = Signal(input_width)
+        frac = Signal(frac_width)
+        m.d.comb += [
+            table_entry.eq(phi[32-input_width:32]),
+            frac.eq(phi[32-input_width-frac_width:32-input_width]),
+        ]
+
+        table = Memory(width=sample_width, depth=2**input_width, init=self.table.tolist(), name="sine")
+        delta = Memory(width=self.delta_width, depth=2**input_width, init=self.delta.tolist(), name="delta")
+        m.submodules.table_rd = table_rd = table.read_port()
+        m.submodules.delta_rd = delta_rd = delta.read_port()
+        m.d.comb += [
+            table_rd.addr.eq(table_entry),
+            delta_rd.addr.eq(table_entry),
+        ]
+
+        # Stage 1: table read, stage 2: multiplier input registers, stage 3: multiplier
+        # output register, stage 4: add the sample and round
+        frac_1 = Signal(frac_width)
+        sample_1 = Signal(signed(sample_width))
+        a_reg = Signal(signed(self.delta_width))
+        b_reg = Signal(signed(frac_width+1))
+        sample_2 = Signal(signed(sample_width))
+        product = Signal(signed(self.delta_width+frac_width+1))
+        sample_3 = Signal(signed(sample_width))
+        result = Signal(signed(sample_width+frac_width+1))
+
+        m.d.comb += [
+            sample_1.eq(table_rd.data),
+            result.eq((sample_3 << frac_width) + product + (1 << (shift-1))),
+        ]
+        m.d.sync += [
+            frac_1.eq(frac),
+            a_reg.eq(delta_rd.data),
+            b_reg.eq(frac_1),
+            sample_2.eq(sample_1),
+            product.eq(a_reg*b_reg),
+            sample_3.eq(sample_2),
+        ]
+
+        sine = result[shift:shift+self.output_width]
+        if self.signed_output:
+            m.d.sync += self.sine_wave_o.eq(sine)
+        else:
+            # Flipping the MSB moves two's complement to offset binary
+            m.d.sync += self.sine_wave_o.eq(sine ^ (1 << (self.output_width-1)))
+
+        return m
+
+    def model(self, phi_inc, samples):
+        # Bit-exact model of the datapath, output n is sine_wave_o latency cycles after the
+        # accumulator held n*phi_inc. Signed output only.
+        input_width = self.sin_input_width
+        frac_width = self.frac_width
+        shift = frac_width + self.guard_bits
+        phi = (np.arange(samples, dtype=np.uint64)*np.uint64(phi_inc)) & np.uint64(2**32-1)
+        entry = (phi >> np.uint64(32-input_width)).astype(np.int64)
+        frac = ((phi >> np.uint64(32-input_width-frac_width)) & np.uint64((2**frac_width)-1)).astype(np.int64)
+        result = (self.table[entry] << frac_width) + self.delta[entry]*frac + (1 << (shift-1))
+        return result >> shift
+
+if __name__ == "__main__":
+    from spectrum import sfdr_db
+
+    # Sweep table size at 18 bit output and measure SFDR, with a truncating table
+    # of the same depth for comparison
+    phi_inc = calc_phi_inc(1234567, 100000000)
+    samples = 2**18
+    print("Table entries, ROM bits, SFDR interpolated (dB), SFDR truncated (dB)")
+    for input_width in range(6, 13):
+        nco = NCO_Interpolated(output_width=18, sin_input_width=input_width, guard_bits=2)
+        rom_bits = lut_size(input_width, 18 + nco.guard_bits)[2] + (2**input_width)*nco.delta_width
+        truncated = nco.table[(np.arange(samples, dtype=np.uint64)*np.uint64(phi_inc)
+            & np.uint64(2**32-1)) >> np.uint64(32-input_width)]
+        print(str(2**input_width) + ", " + str(rom_bits) + ", " +
+            str(round(sfdr_db(nco.model(phi_inc, samples)), 1)) + ", " +
+            str(round(sfdr_db(truncated), 1)))
+
+    # Check the gateware against the model
+    dut = NCO_Interpolated(output_width=16, sin_input_width=9)
+    sim = Simulator(dut)
+    sim.add_clock(10e-9) #100MHz
+    sim_output = []
+
+    def tb():
+        yield dut.phi_inc_i.eq(phi_inc)
+        yield
+        for n in range(0, 1000 + dut.latency):
+            sim_output.append((yield dut.sine_wave_o))
+            yield
+
+    sim.add_sync_process(tb)
+    sim.run()
+    expected = dut.model(phi_inc, 1000).tolist()
+    print("Simulation matches model:", sim_output[dut.latency:] == expected)
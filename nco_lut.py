@@ -1,6 +1,13 @@
 from nmigen import *
 from nmigen.sim import *
+from fractions import Fraction
+import functools
 import math
+import os
+import tempfile
+import numpy as np
+
+table_cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sine_table_cache")
 
 def gen_lookup(entry, input_width, output_width, signed_output=True):
     # Map the integer phase input to a phase in radians
@@ -10,14 +17,122 @@ def gen_lookup(entry, input_width, output_width, signed_output=True):
     # Map the output to a range of uints
     return int((sin_phi)*((2**output_width)-1))
 
-def calc_phi_inc(desired_freq, clock_freq):
-    max_inc = (2**31)-1 #this would result in output frequency of fclk/2
-    ratio = desired_freq/(clock_freq/2)
-    return int(ratio*max_inc)
+def gen_quarter_lookup(entry, input_width, output_width):
+    # First quadrant only, sampled half an LSB off the axis so that the table mirrors exactly
+    # about pi/2. input_width is the width of the full phase, the table has 2**(input_width-2) entries
+    phase = 2.0*math.pi*((entry+0.5)/(2**input_width))
+    # Magnitude only, the sign is restored from the phase MSB
+    return int((math.sin(phase)/2)*((2**output_width)-1))
+
+# Part of every cache file name, bump it whenever gen_table's output changes so old files
+# are never read back
+table_cache_version = 1
+
+@functools.lru_cache(maxsize=None)
+def gen_table(input_width, output_width, signed_output=True, quarter_wave=False):
+    # Whole table in one go, matches gen_lookup/gen_quarter_lookup entry for entry.
+    # Memoized in memory and on disk, the returned array is read only as it is shared.
+    # Anything in the disk cache that doesn't load as the expected table is regenerated.
+    name = "sine_v" + str(table_cache_version) + "_" + str(input_width) + "_" + str(output_width) \
+        + ("_s" if signed_output else "_u") + ("_q" if quarter_wave else "") + ".npy"
+    path = os.path.join(table_cache_dir, name)
+    entries = 2**(input_width-2) if quarter_wave else 2**input_width
+    dtype = np.min_scalar_type(-(2**(output_width-1)) if signed_output else (2**output_width)-1)
+    try:
+        table = np.load(path)
+        if (table.shape != (entries,)) or (table.dtype != dtype):
+            raise ValueError('Cached table does not match')
+    except Exception:
+        phase = np.arange(entries, dtype=np.float64)
+        if quarter_wave:
+            sin_phi = np.sin(2.0*math.pi*((phase+0.5)/(2**input_width)))/2
+        else:
+            sin_phi = np.sin(2.0*math.pi*(phase/((2**input_width)-1)))
+            sin_phi = sin_phi/2 if signed_output else (sin_phi+1)/2
+        table = np.trunc(sin_phi*((2**output_width)-1)).astype(dtype)
+        # Written under a temporary name and renamed into place, so an interrupted build or
+        # two builds at once can't leave a partial file behind
+        temporary = None
+        try:
+            os.makedirs(table_cache_dir, exist_ok=True)
+            with tempfile.NamedTemporaryFile(dir=table_cache_dir, suffix=".npy", delete=False) as f:
+                temporary = f.name
+                np.save(f, table)
+            os.replace(temporary, path)
+        except OSError:
+            # Cache is optional, e.g. read only checkout
+            if temporary and os.path.exists(temporary):
+                os.remove(temporary)
+    table.flags.writeable = False
+    return table
+
+def lut_size(input_width, output_width, quarter_wave=False):
+    # Returns (entries, bits per entry, total bits) of the sine table
+    if quarter_wave:
+        entries, entry_width = 2**(input_width-2), output_width-1
+    else:
+        entries, entry_width = 2**input_width, output_width
+    return entries, entry_width, entries*entry_width
+
+def calc_phi_inc(desired_freq, clock_freq, accumulator_width=32):
+    # Nearest increment, worked out exactly rather than in floating point
+    phi_inc = round(Fraction(str(desired_freq))*(2**accumulator_width)/Fraction(str(clock_freq)))
+    if phi_inc >= 2**(accumulator_width-1):
+        raise ValueError('Frequency must be below fclk/2')
+    return phi_inc
+
+def plan_frequency(desired_freq, clock_freq, max_error=1e-3, max_width=48):
+    # Narrowest accumulator that gets within max_error Hz, up to max_width bits.
+    # Returns (accumulator_width, phi_inc, achieved frequency, error in Hz)
+    for width in range(32, max_width+1):
+        phi_inc = calc_phi_inc(desired_freq, clock_freq, width)
+        achieved = Fraction(phi_inc)*Fraction(str(clock_freq))/(2**width)
+        error = achieved - Fraction(str(desired_freq))
+        if abs(error) <= max_error:
+            return width, phi_inc, float(achieved), float(error)
+    raise ValueError('No accumulator up to max_width bits is within max_error')
+
+def plan_rational(desired_freq, clock_freq, accumulator_width=32):
+    # For a modulus (non power of two) accumulator: the increment is phi_inc + remainder/modulus,
+    # which is exactly desired_freq*2**accumulator_width/clock_freq, so there is no drift.
+    # Returns (phi_inc, remainder, modulus)
+    ratio = Fraction(str(desired_freq))/Fraction(str(clock_freq))
+    if ratio >= Fraction(1, 2):
+        raise ValueError('Frequency must be below fclk/2')
+    phi_inc, remainder = divmod(ratio.numerator*(2**accumulator_width), ratio.denominator)
+    return phi_inc, remainder, ratio.denominator
+
+# Galois form of x^32 + x^22 + x^2 + x + 1, shifting right
+lfsr_taps = 0x80200003
+
+@functools.lru_cache(maxsize=None)
+def lfsr_sequence(length, seed=1):
+    # States of the dither LFSR from reset, for the models. Read only as it is shared.
+    states = np.empty(length, dtype=np.uint64)
+    state = seed
+    for n in range(0, length):
+        states[n] = state
+        state = (state >> 1) ^ lfsr_taps if state & 1 else state >> 1
+    states.flags.writeable = False
+    return states
 
 class NCO_LUT(Elaboratable):
-    def __init__(self, output_width=8, sin_input_width=None, signed_output=True):
-        self.phi_inc_i = Signal(31)
+    # dither_width adds that many LFSR bits to the phase just below the table index, which
+    # turns phase truncation spurs into noise. noise_shaping_bits builds the table that many
+    # bits wider and reduces it to output_width with first order error feedback. That moves
+    # amplitude quantization noise up in frequency, which helps the mean SFDR but not every
+    # tone: with a 10 bit quarter wave table and 8 bits of dither, 4 bits of shaping lowers
+    # the worst case over nco_spur_benchmark.py's sweep from 74.1 to 71.3 dB.
+    # phi_inc_i + fm_i is registered before the accumulator, so the accumulator stays a single
+    # adder and can be retuned every cycle. phase_offset_i is registered and added after the
+    # accumulator, a cycle behind it, phase_reset_i zeroes the accumulator (sync).
+    def __init__(self, output_width=8, sin_input_width=None, signed_output=True, quarter_wave=False,
+        dither_width=0, noise_shaping_bits=0, accumulator_width=32):
+        self.phi_inc_i = Signal(accumulator_width-1)
+        self.fm_i = Signal(signed(accumulator_width))
+        self.phase_offset_i = Signal(accumulator_width)
+        self.phase_reset_i = Signal()
+        self.accumulator_width = accumulator_width
 
         self.signed_output = signed_output
         if (signed_output):
@@ -31,28 +146,199 @@ class NCO_LUT(Elaboratable):
         else:
             self.sin_input_width = output_width
 
+        self.quarter_wave = quarter_wave
+        if quarter_wave and self.sin_input_width < 3:
+            raise ValueError('Quarter wave table needs sin_input_width of at least 3')
+
+        if dither_width > 32:
+            raise ValueError('Dither comes from a 32 bit LFSR, so at most 32 bits')
+        if self.sin_input_width + dither_width > accumulator_width:
+            raise ValueError('Dither must fit below the table index in the accumulator')
+        self.dither_width = dither_width
+        self.noise_shaping_bits = noise_shaping_bits
+
+        self.latency = 3 if quarter_wave else 2     # accumulator to output
+        if noise_shaping_bits:
+            self.latency += 1
+
     def elaborate(self, platform):
         m = Module()
 
-        sin_o = self.sine_wave_o
         input_width = self.sin_input_width
-        output_width = self.output_width
+        output_width = self.output_width + self.noise_shaping_bits
+        if not self.noise_shaping_bits:
+            sin_o = self.sine_wave_o
+        elif self.signed_output:
+            sin_o = Signal(signed(output_width))
+        else:
+            sin_o = Signal(unsigned(output_width))
 
-        phi = Signal(32)
-        m.d.sync += phi.eq(phi + self.phi_inc_i)
+        width = self.accumulator_width
+        phi = Signal(width)
+        phi_next = Signal(width)
+        increment = Signal(width)
+        offset = Signal(width)
+        m.d.sync += [
+            phi.eq(phi_next),
+            increment.eq(self.phi_inc_i + self.fm_i),
+            offset.eq(self.phase_offset_i),
+        ]
+        with m.If(self.phase_reset_i):
+            m.d.comb += phi_next.eq(0)
+        with m.Else():
+            m.d.comb += phi_next.eq(phi + increment)
 
+        # The offset and dither go into a separate phase register so the accumulator itself
+        # stays exact. They are summed in a register of their own and added to the registered
+        # accumulator, so every stage is a single adder. That costs a cycle of latency, the
+        # phase register holds the previous cycle's accumulator value.
+        phase = Signal(width)
+        phase_offset = Signal(width)
         table_entry = Signal(input_width)
-        m.d.comb += table_entry.eq(phi[32-input_width:32])
+        m.d.comb += table_entry.eq(phase[width-input_width:width])
+        m.d.sync += phase.eq(phi + phase_offset)
+        if not self.dither_width:
+            m.d.sync += phase_offset.eq(offset)
+        else:
+            lfsr = Signal(32, reset=1)
+            with m.If(lfsr[0]):
+                m.d.sync += lfsr.eq((lfsr >> 1) ^ lfsr_taps)
+            with m.Else():
+                m.d.sync += lfsr.eq(lfsr >> 1)
+            dither = lfsr[0:self.dither_width] << (width-input_width-self.dither_width)
+            m.d.sync += phase_offset.eq(offset + dither)
+
+        table = gen_table(input_width, output_width, self.signed_output, self.quarter_wave)
 
-        with m.Switch(table_entry):
-            for entry in range(0, 2**input_width):
-                with m.Case(entry):
-                    m.d.sync += sin_o.eq(gen_lookup(entry, input_width, output_width, signed_output=self.signed_output))
+        # Non-transparent read ports register the data with a reset of 0, just like sin_o was
+        if not self.quarter_wave:
+            rom = Memory(width=output_width, depth=2**input_width, name="sine", init=table.tolist())
+            m.submodules.table_rd = read = rom.read_port(transparent=False)
+            m.d.comb += [
+                read.addr.eq(table_entry),
+                sin_o.eq(read.data),
+            ]
+        else:
+            # Top bit of the phase selects the negative half cycle, the next one mirrors the
+            # address within the half cycle. Costs one extra cycle of latency to register
+            # the magnitude before the sign is applied.
+            quarter_entry = Signal(input_width-2)
+            magnitude = Signal(output_width-1)
+            negative = Signal()
+            m.d.comb += quarter_entry.eq(Mux(table_entry[input_width-2], 
+                ~table_entry[0:input_width-2], table_entry[0:input_width-2]))
+            m.d.sync += negative.eq(table_entry[input_width-1])
+
+            rom = Memory(width=output_width-1, depth=2**(input_width-2), name="sine", init=table.tolist())
+            m.submodules.table_rd = read = rom.read_port(transparent=False)
+            m.d.comb += [
+                read.addr.eq(quarter_entry),
+                magnitude.eq(read.data),
+            ]
+
+            sine = Signal(signed(output_width))
+            m.d.comb += sine.eq(Mux(negative, -magnitude, magnitude))
+            if self.signed_output:
+                m.d.sync += sin_o.eq(sine)
+            else:
+                # Flipping the MSB moves two's complement to offset binary
+                m.d.sync += sin_o.eq(sine ^ (1 << (output_width-1)))
+
+        if self.noise_shaping_bits:
+            # Carry the truncated bits into the next sample, saturating at the top of the range
+            error = Signal(self.noise_shaping_bits)
+            shaped = Signal(signed(output_width+2))
+            top = 2**(self.output_width-1)-1 if self.signed_output else 2**self.output_width-1
+            m.d.comb += shaped.eq(sin_o + error)
+            m.d.sync += error.eq(shaped[0:self.noise_shaping_bits])
+            with m.If((shaped >> self.noise_shaping_bits) > top):
+                m.d.sync += self.sine_wave_o.eq(top)
+            with m.Else():
+                m.d.sync += self.sine_wave_o.eq(shaped >> self.noise_shaping_bits)
 
         return m
 
+    def model(self, phi_inc, samples, phase_offset=0):
+        # Bit-exact model with phi_inc_i and phase_offset_i held from reset. Output n is
+        # sine_wave_o latency cycles after the accumulator (last) held n*phi_inc. The offset
+        # register is a cycle behind the increment register, so sample 0 has no offset.
+        input_width = self.sin_input_width
+        output_width = self.output_width + self.noise_shaping_bits
+        width = self.accumulator_width
+        phi = np.arange(samples, dtype=np.uint64)*np.uint64(phi_inc) + np.uint64(phase_offset)
+        phi[0:1] = 0
+        if self.dither_width:
+            # Sample n gets the LFSR state n cycles after reset
+            dither = lfsr_sequence(samples) & np.uint64((2**self.dither_width)-1)
+            phi += dither << np.uint64(width-input_width-self.dither_width)
+        entry = ((phi & np.uint64(2**width-1)) >> np.uint64(width-input_width)).astype(np.int64)
+
+        table = gen_table(input_width, output_width, self.signed_output, self.quarter_wave).astype(np.int64)
+        def lookup(entry):
+            if not self.quarter_wave:
+                return table[entry]
+            low = entry & ((2**(input_width-2))-1)
+            magnitude = table[np.where(entry & 2**(input_width-2), low ^ ((2**(input_width-2))-1), low)]
+            sine = np.where(entry & 2**(input_width-1), -magnitude, magnitude)
+            return sine if self.signed_output else sine + 2**(output_width-1)
+        sine = lookup(entry)
+
+        if self.noise_shaping_bits:
+            # First order error feedback, the error is the running sum modulo 2**noise_shaping_bits.
+            # It runs from reset, so it has also summed the table at phase 0 for the two cycles
+            # before sample 0 reaches the phase register, and for the quarter wave table the
+            # zero the sign stage outputs from its reset state.
+            startup = [lookup(np.zeros(1, dtype=np.int64))[0]]*2
+            if self.quarter_wave:
+                startup = [0 if self.signed_output else 2**(output_width-1)] + startup
+            sine = np.concatenate((startup, sine))
+            error = np.cumsum(sine) & ((2**self.noise_shaping_bits)-1)
+            shaped = sine + np.concatenate(([0], error[:-1]))
+            top = 2**(self.output_width-1)-1 if self.signed_output else 2**self.output_width-1
+            sine = np.minimum(shaped >> self.noise_shaping_bits, top)[len(startup):]
+        return sine
+
+def simulate_held(dut, phi_inc, samples, phase_offset=0):
+    # sine_wave_o of an NCO_LUT in the simulator with phi_inc_i and phase_offset_i held from
+    # reset, aligned with dut.model(phi_inc, samples, phase_offset)
+    outputs = []
+
+    def held_inputs():
+        yield dut.phi_inc_i.eq(phi_inc)
+        yield dut.phase_offset_i.eq(phase_offset)
+        for n in range(0, samples + 1 + dut.latency):
+            yield Settle()
+            outputs.append((yield dut.sine_wave_o))
+            yield Tick()
+
+    sim = Simulator(dut)
+    sim.add_clock(10e-9) #100MHz
+    sim.add_process(held_inputs)
+    sim.run()
+    return outputs[1+dut.latency:]
+
 if __name__ == "__main__":
 
+    print("Sine table size, full wave vs quarter wave (bits)")
+    for width in range(8, 17, 2):
+        full = lut_size(width, width)
+        quarter = lut_size(width, width, quarter_wave=True)
+        print(str(width) + " bit: " + str(full[0]) + "x" + str(full[1]) + "=" + str(full[2]) + 
+            ", " + str(quarter[0]) + "x" + str(quarter[1]) + "=" + str(quarter[2]))
+
+    # Gateware against model() from reset, with the frequency and offset held from the start
+    print("Output, table, dither, noise shaping bits, matches model")
+    phi_inc = calc_phi_inc(1234567, 100000000)
+    phase_offset = 0x5a3c1234
+    for signed_output, quarter_wave, dither_width, noise_shaping_bits in [
+            (True, False, 0, 0), (True, True, 4, 0), (False, False, 4, 4), (False, True, 8, 4)]:
+        dut = NCO_LUT(output_width=8, sin_input_width=10, signed_output=signed_output,
+            quarter_wave=quarter_wave, dither_width=dither_width, noise_shaping_bits=noise_shaping_bits)
+        print(("signed" if signed_output else "unsigned") + ", " +
+            ("quarter" if quarter_wave else "full") + ", " + str(dither_width) + ", " +
+            str(noise_shaping_bits) + ", " + str(simulate_held(dut, phi_inc, 300, phase_offset) ==
+            dut.model(phi_inc, 300, phase_offset).tolist()))
+
     dut = NCO_LUT(signed_output=True)
     sim = Simulator(dut)
     sim.add_clock(10e-9) #100MHz
@@ -7,7 +7,7 @@ import math
 class NCO_LUT_Pipelined(Elaboratable):
     # Instantiates a BRAM with the data output register to achieve much higher frequencies than
     # otherwise possible (with inferred ROM), up to the BRAM Fmax when tested
-    def __init__(self, output_width=8, sin_input_width=None, signed_output=True):
+    def __init__(self, output_width=8, sin_input_width=None, signed_output=True, quarter_wave=False):
         self.phi_inc_i = Signal(31)
 
         self.signed_output = signed_output
@@ -22,6 +22,13 @@ class NCO_LUT_Pipelined(Elaboratable):
         else:
             self.sin_input_width = output_width
 
+        self.quarter_wave = quarter_wave
+        if quarter_wave and self.sin_input_width < 3:
+            raise ValueError('Quarter wave table needs sin_input_width of at least 3')
+        # Address register in the BRAM plus the data output register
+        self.bram_latency = 2
+        self.latency = self.bram_latency + 2   # phase register to output
+
     def elaborate(self, platform):
         m = Module()
 
@@ -33,16 +40,35 @@ class NCO_LUT_Pipelined(Elaboratable):
         m.d.sync += phi.eq(phi + self.phi_inc_i)        
         m.d.comb += table_entry.eq(phi[32-input_width:32])
 
-        init = []
-        for entry in range(0, 2**input_width):
-            init.append(gen_lookup(entry, input_width, output_width, signed_output=self.signed_output))
-        init = generate_init_data(16, init, signed_output=True)
+        init = gen_table(input_width, output_width, self.signed_output, self.quarter_wave)
+        init = generate_init_data(16, init.tolist(), signed_output=True)
 
         m.submodules.brom = brom = BROMWrapper(init)
-        m.d.sync += [
-            self.sine_wave_o.eq(brom.read_port[0:output_width]),
-            brom.address.eq(table_entry),
-        ]
+
+        if not self.quarter_wave:
+            m.d.sync += [
+                self.sine_wave_o.eq(brom.read_port[0:output_width]),
+                brom.address.eq(table_entry),
+            ]
+        else:
+            # Mirror the address in the second and fourth quadrants, then delay the sign
+            # to line up with the BRAM output and apply it in the output register
+            negative = Signal(1 + self.bram_latency)
+            magnitude = Signal(output_width-1)
+            sine = Signal(signed(output_width))
+            m.d.comb += [
+                magnitude.eq(brom.read_port[0:output_width-1]),
+                sine.eq(Mux(negative[-1], -magnitude, magnitude)),
+            ]
+            m.d.sync += [
+                brom.address.eq(Mux(table_entry[input_width-2], 
+                    ~table_entry[0:input_width-2], table_entry[0:input_width-2])),
+                negative.eq(Cat(table_entry[input_width-1], negative[0:-1])),
+            ]
+            if self.signed_output:
+                m.d.sync += self.sine_wave_o.eq(sine)
+            else:
+                m.d.sync += self.sine_wave_o.eq(sine ^ (1 << (output_width-1)))
 
         return m
 
@@ -0,0 +1,108 @@
+from nmigen import *
+from nmigen.sim import *
+import math
+
+from nco_lut import *
+
+class NCO_Parallel(Elaboratable):
+    # Produces lanes consecutive samples per clock from one phi_inc_i. The accumulator steps by
+    # lanes*phi_inc and each lane adds its own k*phi_inc offset, then reads its own port of a
+    # shared table Memory (two lanes share one dual-port BRAM, more lanes replicate the ROM).
+    # sine_wave_o has lane 0 (the earliest sample) in the LSBs, ready for a serializer.
+    def __init__(self, lanes=4, output_width=8, sin_input_width=None, signed_output=True):
+        if lanes < 1:
+            raise ValueError('Need at least one lane')
+
+        self.phi_inc_i = Signal(31)
+
+        self.signed_output = signed_output
+        if (signed_output):
+            self.lanes_o = [Signal(shape=signed(output_width), name="lane_"+str(k))
+                for k in range(0, lanes)]
+        else:
+            self.lanes_o = [Signal(shape=unsigned(output_width), name="lane_"+str(k))
+                for k in range(0, lanes)]
+        self.sine_wave_o = Signal(lanes*output_width)
+
+        self.lanes = lanes
+        self.output_width = output_width
+        if sin_input_width:
+            self.sin_input_width = sin_input_width
+        else:
+            self.sin_input_width = output_width
+        self.latency = 2    # phase register to output
+
+    def elaborate(self, platform):
+        m = Module()
+
+        input_width = self.sin_input_width
+        output_width = self.output_width
+
+        step = Signal(32)
+        offsets = [Signal(32, name="offset_"+str(k)) for k in range(0, self.lanes)]
+        m.d.sync += step.eq(self.phi_inc_i*self.lanes)
+        for k in range(0, self.lanes):
+            m.d.sync += offsets[k].eq(self.phi_inc_i*k)
+
+        phi = Signal(32)
+        m.d.sync += phi.eq(phi + step)
+
+        table = Memory(width=output_width, depth=2**input_width, name="sine",
+            init=gen_table(input_width, output_width, self.signed_output).tolist())
+
+        for k in range(0, self.lanes):
+            lane_phi = Signal(32, name="lane_phi_"+str(k))
+            m.d.sync += lane_phi.eq(phi + offsets[k])
+
+            read = table.read_port()
+            setattr(m.submodules, "table_rd_"+str(k), read)
+            m.d.comb += [
+                read.addr.eq(lane_phi[32-input_width:32]),
+                self.lanes_o[k].eq(read.data),
+            ]
+
+        m.d.comb += self.sine_wave_o.eq(Cat(*self.lanes_o))
+
+        return m
+
+if __name__ == "__main__":
+
+    # Interleaved lanes should reproduce the serial NCO_LUT output
+    lanes = 4
+    clocks = 200
+    phi_inc = calc_phi_inc(9000000, 400000000)
+    dut = NCO_Parallel(lanes=lanes, output_width=8)
+    parallel_output = []
+    serial_output = []
+
+    def parallel_tb():
+        yield dut.phi_inc_i.eq(phi_inc)
+        for n in range(0, clocks):
+            yield
+            for k in range(0, lanes):
+                parallel_output.append((yield dut.lanes_o[k]))
+
+    sim = Simulator(dut)
+    sim.add_clock(10e-9) #100MHz
+    sim.add_sync_process(parallel_tb)
+    sim.run()
+
+    ref = NCO_LUT(output_width=8)
+
+    def serial_tb():
+        yield ref.phi_inc_i.eq(phi_inc)
+        for n in range(0, clocks*lanes):
+            yield
+            serial_output.append((yield ref.sine_wave_o))
+
+    sim = Simulator(ref)
+    sim.add_clock(2.5e-9) #400MHz
+    sim.add_sync_process(serial_tb)
+    sim.run()
+
+    # Lane 0 of the first full clock is phase 0, as is the serial output after its latency
+    # and the increment register
+    parallel_output = parallel_output[lanes*(dut.latency+1):]
+    serial_output = serial_output[ref.latency+1:ref.latency+1+len(parallel_output)]
+    matched = parallel_output == serial_output
+    print(str(lanes) + " lanes, matches serial NCO_LUT:", matched)
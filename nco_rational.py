@@ -0,0 +1,76 @@
+from nmigen import *
+from nmigen.sim import *
+import math
+
+from nco_lut import *
+
+class NCO_Rational(Elaboratable):
+    # Exact rational frequency, for long running tones that must not drift against the
+    # sample clock. A second accumulator counts remainder modulo modulus and carries an
+    # extra 1 into the NCO_LUT increment (through fm_i) each time it wraps, so on average
+    # the phase advances by exactly desired_freq*2**accumulator_width/clock_freq per cycle.
+    def __init__(self, tone_frequency=440, clk_frequency=100000000, accumulator_width=32, **nco_args):
+        self.phi_inc, self.remainder, self.modulus = plan_rational(tone_frequency, clk_frequency,
+            accumulator_width)
+
+        self.nco = NCO_LUT(accumulator_width=accumulator_width, **nco_args)
+        self.sine_wave_o = self.nco.sine_wave_o
+        self.latency = self.nco.latency
+
+    def elaborate(self, platform):
+        m = Module()
+
+        m.submodules.nco = nco = self.nco
+
+        carry = Signal()
+        m.d.comb += [
+            nco.phi_inc_i.eq(self.phi_inc),
+            nco.fm_i.eq(carry),
+        ]
+
+        if self.remainder:
+            modulus_acc = Signal(range(self.modulus))
+            with m.If(modulus_acc >= self.modulus - self.remainder):
+                m.d.sync += modulus_acc.eq(modulus_acc - (self.modulus - self.remainder))
+                m.d.comb += carry.eq(1)
+            with m.Else():
+                m.d.sync += modulus_acc.eq(modulus_acc + self.remainder)
+
+        return m
+
+if __name__ == "__main__":
+
+    tone_frequency = 440
+    clk_frequency = 100000000
+    hours = 1
+    cycles = clk_frequency*3600*hours
+
+    phi_inc = calc_phi_inc(tone_frequency, clk_frequency)
+    achieved = phi_inc*clk_frequency/(2**32)
+    print("32 bit accumulator: phi_inc", phi_inc, "gives", achieved, "Hz, drift after", hours,
+        "hour(s):", round(360*(achieved-tone_frequency)*3600*hours, 1), "degrees")
+
+    width, phi_inc, achieved, error = plan_frequency(tone_frequency, clk_frequency, max_error=1e-6)
+    print(str(width) + " bit accumulator: phi_inc", phi_inc, "gives", achieved, "Hz, drift after", hours,
+        "hour(s):", round(360*error*3600*hours, 3), "degrees")
+
+    dut = NCO_Rational(tone_frequency, clk_frequency, output_width=8)
+    print("Modulus accumulator: phi_inc", dut.phi_inc, "+", dut.remainder, "/", dut.modulus,
+        "repeats exactly every", dut.modulus, "cycles, no drift")
+
+    # The carries should add up to exactly the remainder over one modulus period. 100MHz has
+    # too long a period to simulate, so check 440Hz at the 48kHz AC97 rate instead
+    check = NCO_Rational(tone_frequency, 48000, output_width=8)
+    sim = Simulator(check)
+    sim.add_clock(1/48000)
+    carries = [0]
+
+    def tb():
+        for n in range(0, check.modulus):
+            yield
+            carries[0] += (yield check.nco.fm_i)
+
+    sim.add_sync_process(tb)
+    sim.run()
+    print("440Hz at 48kHz: phi_inc", check.phi_inc, "+", check.remainder, "/", check.modulus,
+        ", carries over one period:", carries[0])
@@ -0,0 +1,50 @@
+import sys
+import numpy as np
+
+from nco_lut import *
+from spectrum import sfdr_db
+
+# Worst case SFDR of NCO_LUT across a sweep of tuning words, with and without phase dither
+# and output noise shaping. Uses the bit-exact NCO_LUT.model rather than the simulator, after
+# checking the model against the simulator for the most involved configuration.
+# The full wave table from gen_lookup spans 2**n-1 steps rather than 2**n, the discontinuity
+# at the wrap sets its own spur floor, so both it and the quarter wave table are measured.
+# Noise shaping is not a win for every tone: with the 10 bit quarter wave table and 8 bits of
+# dither it raises the mean SFDR but lowers the worst case.
+# Usage: python nco_spur_benchmark.py [sin_input_width] [output_width]
+
+clk_frequency = 100000000
+samples = 2**16
+frequencies = np.linspace(500e3, 20e6, 40)
+
+def sweep(**options):
+    nco = NCO_LUT(**options)
+    results = [sfdr_db(nco.model(calc_phi_inc(f, clk_frequency), samples)) for f in frequencies]
+    return min(results), np.mean(results)
+
+if __name__ == "__main__":
+    input_width = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    output_width = int(sys.argv[2]) if len(sys.argv) > 2 else 12
+
+    configs = [
+        ("No dither", {}),
+        ("Dither 2 bits", {"dither_width": 2}),
+        ("Dither 4 bits", {"dither_width": 4}),
+        ("Dither 8 bits", {"dither_width": 8}),
+        ("Dither 8 bits, shaping 4 bits", {"dither_width": 8, "noise_shaping_bits": 4}),
+    ]
+
+    print(str(input_width) + " bit phase, " + str(output_width) + " bit output, " + 
+        str(len(frequencies)) + " tones from " + str(frequencies[0]/1e6) + " to " + 
+        str(frequencies[-1]/1e6) + " MHz at " + str(clk_frequency/1e6) + " MHz clock")
+    check = NCO_LUT(output_width=output_width, sin_input_width=input_width, quarter_wave=True,
+        dither_width=8, noise_shaping_bits=4)
+    check_phi_inc = calc_phi_inc(frequencies[1], clk_frequency)
+    print("Model matches simulator, quarter wave, dither 8 bits, shaping 4 bits, 4096 samples:",
+        simulate_held(check, check_phi_inc, 4096) == check.model(check_phi_inc, 4096).tolist())
+    print("Table, configuration, worst SFDR (dB), mean SFDR (dB)")
+    for table, quarter_wave in [("Full wave", False), ("Quarter wave", True)]:
+        for name, options in configs:
+            worst, mean = sweep(output_width=output_width, sin_input_width=input_width, 
+                quarter_wave=quarter_wave, **options)
+            print(table + ", " + name + ", " + str(round(worst, 1)) + ", " + str(round(mean, 1)))
@@ -1,5 +1,7 @@
 from nmigen import *
 from nmigen.sim import *
+import numpy as np
+from scipy import signal
 
 class PDM(Elaboratable):
     def __init__(self, resolution):
@@ -29,7 +31,286 @@ class PDM(Elaboratable):
       
         return m
 
+    def model(self, inputs):
+        # Bit-exact pdm_out for one input per clock, applied with write_en held high (so each
+        # takes effect a clock later). The carry out of the accumulator is the change in the
+        # integer part of the running sum, so this is a cumulative sum, not a loop.
+        inputs = np.asarray(inputs, dtype=np.int64)
+        running = np.concatenate(([0], np.cumsum(inputs)[:-1])) >> self.resolution
+        return np.diff(running, prepend=0).astype(np.uint8)
+
+def synthesize_ntf(order, osr, h_inf=1.5, optimize_zeros=False):
+    # Noise transfer function zeros and poles. Zeros are at DC, or spread over the signal
+    # band at the Legendre nodes (least in-band noise) for resonator topologies. Poles are
+    # from a Butterworth highpass, with the cutoff bisected until the out of band gain is
+    # h_inf. Lee's rule, h_inf=1.5, keeps single bit loops stable for inputs up to about
+    # 0.7 of full scale at orders 3-5, multi-bit quantizers can take a higher h_inf.
+    if optimize_zeros:
+        zeros = np.exp(1j*np.pi/osr*np.polynomial.legendre.leggauss(order)[0])
+    else:
+        zeros = np.ones(order)
+    w = np.linspace(0, np.pi, 4096)
+    low, high = 1e-6, 0.999
+    for n in range(0, 60):
+        cutoff = (low+high)/2
+        poles = signal.butter(order, cutoff, 'high', output='zpk')[1]
+        if np.max(np.abs(signal.freqz_zpk(zeros, poles, 1, worN=w)[1])) > h_inf:
+            high = cutoff
+        else:
+            low = cutoff
+    return zeros, signal.butter(order, low, 'high', output='zpk')[1]
+
+def resonator_role(i, order, topology):
+    # CRFB pairs up integrators from the end, odd orders leave the first one on its own.
+    # Returns (first of a pair, second of a pair)
+    if (topology != 'CRFB') or (i < order % 2):
+        return False, False
+    return (i - order % 2) % 2 == 0, (i - order % 2) % 2 == 1
+
+def modulator_step(states, u, v, a, b, g, topology):
+    # One clock of the loop filter, shared by the coefficient fitting and the model.
+    # Integrators all delay, except the second of each CRFB resonator pair, which takes
+    # the first's new value so the resonator poles sit exactly on the unit circle.
+    order = len(states)
+    new = list(states)
+    for i in range(0, order):
+        resonator_first, resonator_second = resonator_role(i, order, topology)
+        total = states[i] + (b*u if i == 0 else (new[i-1] if resonator_second else states[i-1])) - a[i]*v
+        if resonator_first:
+            total -= g[(i - order % 2)//2]*states[i+1]
+        new[i] = total
+    return new
+
+def realize_ntf(zeros, poles, topology='CIFB'):
+    # Feedback coefficients a, input coefficient b and resonator coefficients g so that the
+    # loop filter from the quantizer output matches 1 - 1/NTF (least squares on its impulse
+    # response) and the signal transfer function has unity DC gain
+    order = len(zeros)
+    numerator = np.real(np.poly(zeros))
+    denominator = np.real(np.poly(poles))
+    g = []
+    if topology == 'CRFB':
+        for angle in sorted(np.angle(zeros[np.imag(zeros) > 0])):
+            g.append(2 - 2*np.cos(angle))
+    length = 8*order + 32
+    impulse = np.zeros(length)
+    impulse[0] = 1
+    target = signal.lfilter(numerator - denominator, numerator, impulse)
+    responses = []
+    for i in range(0, order):
+        a = np.zeros(order)
+        a[i] = 1
+        states = np.zeros(order)
+        response = []
+        for n in range(0, length):
+            response.append(states[-1])
+            states = modulator_step(states, 0, impulse[n], a, 0, g, topology)
+        responses.append(response)
+    a = np.linalg.lstsq(np.array(responses).T, target, rcond=None)[0]
+
+    # Closed loop (v = y) DC gain from the input with b = 1
+    states = np.zeros(order)
+    for n in range(0, 4096):
+        states = modulator_step(states, 1, states[-1], a, 1, g, topology)
+    return list(a), 1/states[-1], g
+
+class PDM_HighOrder(Elaboratable):
+    # Drop in for PDM with an order 2-5 noise shaping loop: CIFB (cascade of integrators,
+    # distributed feedback) with all NTF zeros at DC, or CRFB (resonator feedback) with the
+    # zeros spread over the band below clk/(2*osr). output_bits > 1 gives a multi-bit
+    # quantizer, pdm_out is then a level from 0 to 2**output_bits-1, and the average level
+    # is input/2**resolution of full scale either way.
+    # Integrators count in units where full scale is 2**(resolution+coefficient_bits)*
+    # (2**output_bits-1), so the input and feedback products are exact and only the small
+    # resonator terms are truncated, after the noise shaping. Every integrator is limited to
+    # twice the largest value seen in a float simulation at half (1 bit) or 0.7 (multi-bit) of
+    # full scale. Going past a limit means the loop is overloaded, and it is reset rather
+    # than left to wrap or stick.
+    def __init__(self, resolution, order=3, topology='CIFB', output_bits=1, osr=64, h_inf=1.5,
+        coefficient_bits=16):
+        if not (2 <= order <= 5):
+            raise ValueError('Order must be 2 to 5')
+        if topology not in ('CIFB', 'CRFB'):
+            raise ValueError('Topology must be CIFB or CRFB')
+
+        self.input = Signal(resolution)
+        self.pdm_out = Signal(output_bits, reset_less=True)
+        self.write_en = Signal()
+        self.resolution = resolution
+        self.order = order
+        self.topology = topology
+        self.output_bits = output_bits
+        self.osr = osr
+        self.coefficient_bits = coefficient_bits
+
+        self.zeros, self.poles = synthesize_ntf(order, osr, h_inf, topology == 'CRFB')
+        a, b, g = realize_ntf(self.zeros, self.poles, topology)
+        self.a = [round(c*2**coefficient_bits) for c in a]
+        self.b = round(b*2**coefficient_bits)
+        self.g = [round(c*2**coefficient_bits) for c in g]
+
+        # Integrator limits from a float run at a safe input level
+        levels = 2**output_bits - 1
+        amplitude = 0.5 if output_bits == 1 else 0.7
+        u = amplitude*np.sin(2*np.pi*np.arange(0, 8192)*1.5/osr/64)
+        states = np.zeros(order)
+        peaks = np.zeros(order)
+        for n in range(0, len(u)):
+            v = np.clip(np.round((states[-1]*levels + levels)/2), 0, levels)*2/levels - 1
+            states = modulator_step(states, u[n], v, a, b, g, topology)
+            peaks = np.maximum(peaks, np.abs(states))
+        if np.max(peaks) > 100:
+            raise ValueError('Loop is unstable, try a lower h_inf or more output bits')
+        self.full_scale = (2**resolution)*levels
+        self.limits = [int(2**np.ceil(np.log2(2*peak*self.full_scale*2**coefficient_bits))) - 1
+            for peak in peaks]
+
+    def quantize(self, y):
+        shift = self.resolution + self.coefficient_bits
+        return min(max((y + 2**(shift+self.output_bits)) >> (shift+1), 0), 2**self.output_bits - 1)
+
+    def elaborate(self, platform):
+        m = Module()
+
+        order = self.order
+        c = self.coefficient_bits
+        levels = 2**self.output_bits - 1
+        input_reg = Signal(self.resolution)
+        states = [Signal(range(-limit, limit+1), name="integrator_"+str(i))
+            for i, limit in enumerate(self.limits)]
+
+        with m.If(self.write_en):
+            m.d.sync += input_reg.eq(self.input)
+
+        # Quantize the last integrator, clamping multi-bit codes to the end levels
+        level = Signal(self.output_bits)
+        quantizer = Signal(signed(len(states[-1])+2))
+        shift = self.resolution + c
+        m.d.comb += quantizer.eq((states[-1] + 2**(shift+self.output_bits)) >> (shift+1))
+        with m.If(quantizer < 0):
+            m.d.comb += level.eq(0)
+        with m.Elif(quantizer > levels):
+            m.d.comb += level.eq(levels)
+        with m.Else():
+            m.d.comb += level.eq(quantizer)
+        m.d.sync += self.pdm_out.eq(level)
+
+        # Unsigned arithmetic stays unsigned, so widen into signed values first
+        input_signed = Signal(signed(self.resolution+1))
+        level_signed = Signal(signed(self.output_bits+1))
+        u = Signal(signed(self.resolution+self.output_bits+2))
+        v = Signal(signed(self.resolution+self.output_bits+2))
+        m.d.comb += [
+            input_signed.eq(input_reg),
+            level_signed.eq(level),
+            u.eq((2*input_signed - 2**self.resolution)*levels),
+            v.eq((2*level_signed - levels) << self.resolution),
+        ]
+
+        new = []
+        overloads = []
+        for i in range(0, order):
+            resonator_first, resonator_second = resonator_role(i, order, self.topology)
+            if i == 0:
+                stage_input = u*self.b
+            elif resonator_second:
+                stage_input = new[i-1]
+            else:
+                stage_input = states[i-1]
+            total = states[i] + stage_input - v*self.a[i]
+            if resonator_first:
+                total = total - ((states[i+1]*self.g[(i - order % 2)//2]) >> c)
+            # Saturate, the clamped value also feeds a resonator's second integrator
+            clamped = Signal.like(states[i], name="clamped_"+str(i))
+            limit = self.limits[i]
+            m.d.comb += clamped.eq(Mux(total > limit, limit, Mux(total < -limit, -limit, total)))
+            new.append(clamped)
+            overloads.append((total > limit) | (total < -limit))
+
+        # A clamped high order loop can stay stuck in a limit cycle after the overload has
+        # gone, so start again from zero instead
+        with m.If(Cat(*overloads).any()):
+            m.d.sync += [state.eq(0) for state in states]
+        with m.Else():
+            m.d.sync += [state.eq(clamped) for state, clamped in zip(states, new)]
+
+        return m
+
+    def model(self, inputs):
+        # Bit-exact pdm_out levels for one input per clock, applied with write_en held high
+        # (so each takes effect a clock later, as in the gateware)
+        order = self.order
+        c = self.coefficient_bits
+        levels = 2**self.output_bits - 1
+        states = [0]*order
+        input_reg = 0
+        outputs = []
+        for sample in inputs:
+            level = self.quantize(states[-1])
+            outputs.append(level)
+            u = (2*input_reg - 2**self.resolution)*levels
+            v = (2*level - levels) << self.resolution
+            new = list(states)
+            overload = False
+            for i in range(0, order):
+                resonator_first, resonator_second = resonator_role(i, order, self.topology)
+                if i == 0:
+                    stage_input = u*self.b
+                elif resonator_second:
+                    stage_input = new[i-1]
+                else:
+                    stage_input = states[i-1]
+                total = states[i] + stage_input - v*self.a[i]
+                if resonator_first:
+                    total -= (states[i+1]*self.g[(i - order % 2)//2]) >> c
+                new[i] = min(max(total, -self.limits[i]), self.limits[i])
+                overload = overload or (new[i] != total)
+            states = [0]*order if overload else new
+            input_reg = int(sample)
+        return np.array(outputs)
+
 if __name__=="__main__":
+
+    # In-band SNR against the first order PDM at the same oversampling ratio, -6dB sine
+    from spectrum import inband_snr_db
+    osr = 64
+    samples = 2**16
+    frequency = 101/samples
+    inputs = np.round(2**15 + 2**14*np.sin(2*np.pi*frequency*np.arange(0, samples))).astype(np.int64)
+    carries = np.floor_divide(np.cumsum(inputs), 2**16)
+    print("Modulator, in-band SNR (dB) at OSR", osr)
+    print("PDM, " + str(round(inband_snr_db(np.diff(carries, prepend=0), frequency, osr), 1)))
+    for topology, output_bits in [('CIFB', 1), ('CRFB', 1), ('CRFB', 3)]:
+        for order in range(2, 6):
+            dut = PDM_HighOrder(16, order, topology, output_bits, osr)
+            print("PDM_HighOrder " + topology + " order " + str(order) + " " + str(output_bits) +
+                " bit, " + str(round(inband_snr_db(dut.model(inputs), frequency, osr), 1)))
+
+    # Check the gateware against the model, including an overload reset from a full scale step.
+    # Inputs are held from reset, so input n reaches input_reg in cycle n+1 and the level
+    # quantized in cycle n is on pdm_out in cycle n+1.
+    check = np.concatenate((inputs[0:1500], [2**16-1]*300, inputs[0:200]))
+    for topology, order, output_bits in [('CIFB', 3, 1), ('CRFB', 4, 1), ('CRFB', 5, 3)]:
+        dut = PDM_HighOrder(16, order, topology, output_bits, osr)
+        outputs = []
+
+        def held_inputs():
+            yield dut.write_en.eq(1)
+            for n in range(0, len(check)+1):
+                if n < len(check):
+                    yield dut.input.eq(int(check[n]))
+                yield Settle()
+                if n:
+                    outputs.append((yield dut.pdm_out))
+                yield Tick()
+
+        sim = Simulator(dut)
+        sim.add_clock(10e-9) #100MHz
+        sim.add_process(held_inputs)
+        sim.run()
+        print("PDM_HighOrder " + topology + " order " + str(order) + " " + str(output_bits) +
+            " bit, simulation matches model:", outputs == dut.model(check).tolist())
+
     resolution = 4
     periods = 1
     dut = PDM(resolution)
@@ -1,5 +1,6 @@
 from nmigen import *
 from nmigen.sim import *
+import numpy as np
 
 class PWM(Elaboratable):
     def __init__(self, resolution = 8, no_reset = True):
@@ -31,8 +32,111 @@ class PWM(Elaboratable):
 
         return m
 
+    def model(self, values):
+        # Bit-exact pwm_o for each clock, with values[k] on input_value_i through PWM period k
+        # and write_enable_i low. Period k runs with the value loaded at the end of period k-1
+        # (0 out of reset), high for its first value+1 clocks, but only if the value it
+        # replaced was non-zero (or after reset).
+        period = 2**self.resolution
+        values = np.asarray(values, dtype=np.int64)
+        active = np.concatenate(([0], values[:-1]))
+        start = np.concatenate(([True], active[:-1] != 0))
+        count = np.arange(0, period)
+        output = start[:, None] & ((count[None, :] == 0) | (count[None, :] <= active[:, None]))
+        return output.reshape(-1).astype(np.uint8)
+
+class PWM_HighRes(Elaboratable):
+    # PWM with lanes output bits per clock, for a serializer (OSERDES) running at lanes times
+    # the clock, or lanes phases of a multi-phase clock. A coarse counter of resolution -
+    # log2(lanes) bits steps once per clock, and the fine bits pick how many lanes of the
+    # boundary clock are high, so the carrier is clk*lanes/2**resolution rather than
+    # clk/2**resolution. pwm_o has lane 0 (the earliest) in the LSB, like NCO_Parallel.
+    # input_value_i is taken into a pending register on write_enable_i and only copied to
+    # the active value as a period ends (the count.all() reload in PWM), so an update never
+    # cuts a pulse short or doubles it. Duty cycle is value/2**resolution.
+    def __init__(self, resolution=12, lanes=8, no_reset=True):
+        if (lanes < 1) or (lanes & (lanes-1)):
+            raise ValueError('Lanes must be a power of two')
+        fine_bits = lanes.bit_length()-1
+        if resolution <= fine_bits:
+            raise ValueError('Resolution must be more than log2(lanes) bits')
+
+        self.input_value_i = Signal(resolution)
+        self.write_enable_i = Signal()
+        self.pwm_o = Signal(lanes)
+        self.period_start_o = Signal()  # High with the first clock of each period on pwm_o
+
+        self.resolution = resolution
+        self.lanes = lanes
+        self.fine_bits = fine_bits
+        self.no_reset = no_reset
+        self.period = 2**(resolution-fine_bits)    # Clocks per PWM period
+
+    def elaborate(self, platform):
+        m = Module()
+
+        coarse_width = self.resolution - self.fine_bits
+        count = Signal(coarse_width, reset_less=self.no_reset)
+        pending = Signal(self.resolution)
+        active = Signal(self.resolution)
+        m.d.sync += count.eq(count + 1)
+
+        with m.If(self.write_enable_i):
+            m.d.sync += pending.eq(self.input_value_i)
+
+        with m.If(count.all()):
+            m.d.sync += active.eq(pending)
+
+        # Whole clocks before the edge are high, the edge clock has active_fine lanes high
+        active_coarse = active[self.fine_bits:]
+        active_fine = active[0:self.fine_bits]
+        lanes = Signal(self.lanes)
+        for k in range(0, self.lanes):
+            m.d.comb += lanes[k].eq((count < active_coarse) |
+                ((count == active_coarse) & (k < active_fine)))
+
+        m.d.sync += [
+            self.pwm_o.eq(lanes),
+            self.period_start_o.eq(count == 0),
+        ]
+
+        return m
+
+    def model(self, values):
+        # Bit-exact serial stream (lane 0 of each clock first) with values[k] active for
+        # period k. Period k is high for exactly values[k] of its 2**resolution bits.
+        values = np.asarray(values, dtype=np.int64)
+        bits = np.arange(0, 2**self.resolution)
+        return (bits[None, :] < values[:, None]).reshape(-1).astype(np.uint8)
+
 if __name__ == "__main__":
 
+    # PWM_HighRes against its model, with a stray write before each period's real value to
+    # check only the last write before the boundary is used. Values written during period p
+    # are active in period p+1, so the model gets a 0 (out of reset) in front
+    import random
+
+    hr = PWM_HighRes(12, 8)
+    values = [random.randint(0, 2**12-1) for n in range(0, 10)] + [0, 2**12-1]
+    words = []
+
+    def hr_tb():
+        for value in values:
+            for c in range(0, hr.period):
+                yield hr.write_enable_i.eq((c == hr.period//2) | (c == hr.period//2+1))
+                yield hr.input_value_i.eq(value if c > hr.period//2 else random.randint(0, 2**12-1))
+                yield
+                words.append((yield hr.pwm_o))
+
+    sim = Simulator(hr)
+    sim.add_clock(10e-9) #100MHz
+    sim.add_sync_process(hr_tb)
+    sim.run()
+    bits = np.array([(w >> k) & 1 for w in words for k in range(0, hr.lanes)], dtype=np.uint8)
+    print("PWM_HighRes", hr.resolution, "bits,", hr.lanes, "lanes: carrier",
+        round(100e6/hr.period/1e3, 1), "kHz (PWM", round(100e6/2**hr.resolution/1e3, 1),
+        "kHz), matches model:", np.array_equal(bits, hr.model([0] + values)[0:len(bits)]))
+
     dut = PWM(8)
     sim = Simulator(dut)
     sim.add_clock(10e-9) #100MHz
@@ -2,6 +2,7 @@ from sys import maxsize
 from nmigen import *
 from nmigen.sim import *
 import math
+import numpy as np
 
 class SigmaDelta_ADC(Elaboratable):
     def __init__(self, k=15):
@@ -39,7 +40,266 @@ class SigmaDelta_ADC(Elaboratable):
 
         return m
 
+class SigmaDelta_ADC_SecondOrder(Elaboratable):
+    # Second order loop for the same comparator and RC integrator. The RC is the first
+    # integrator, the second is a digital up/down integrator, stepped by step LSBs towards
+    # the comparator's decision each clock. Its value drives the RC through a first order
+    # sigma-delta DAC on two feedback pins, feedback[1] through R and feedback[0] through
+    # 2R, giving four levels (0, 1/3, 2/3, 1 of the supply) instead of two. The finer
+    # feedback cuts the ripple the comparator sees, and the integrator value averaged over
+    # k clocks is the bits wide raw_output. step has to be at least the input's steepest
+    # slope in LSBs per clock, larger steps track faster but add noise.
+    #
+    # Calibration: hold calibrate_low_i (or calibrate_high_i) with references[0] (or [1]),
+    # as a fraction of the supply, on the input. 2**average_log2 conversions are averaged,
+    # after as many again to settle, and once both ends are measured output is corrected to
+    # read the reference values there, (raw_output - low)*gain + references[0]. This takes
+    # out comparator offset and supply error, not mismatch between the two resistors.
+    # Out of reset gain is 1 and offset 0.
+    def __init__(self, k=64, bits=12, step=8, references=(0.25, 0.75), average_log2=4,
+        gain_bits=12):
+        if (k<=1) or (k & (k-1)):
+            raise ValueError("k must be a power of two greater than 1")
+        if not (0 <= references[0] < references[1] <= 1):
+            raise ValueError("references must be increasing fractions of full scale")
+
+        self.comparator = Signal()
+        self.feedback = Signal(2)
+        self.raw_output = Signal(bits)
+        self.output = Signal(bits)
+        self.new_output = Signal()
+
+        self.calibrate_low_i = Signal()
+        self.calibrate_high_i = Signal()
+        self.calibrated_o = Signal()
+
+        self.k = k
+        self.bits = bits
+        self.step = step
+        self.reference_codes = [min(round(r*2**bits), 2**bits-1) for r in references]
+        self.average_log2 = average_log2
+        self.gain_bits = gain_bits
+
+    def elaborate(self, platform):
+        m = Module()
+
+        bits = self.bits
+        full_scale = 2**bits - 1
+
+        # Digital integrator, clamped to the output range
+        integrator = Signal(range(2**bits), reset=2**(bits-1))
+        integrator_signed = Signal(signed(bits+2))
+        stepped = Signal(signed(bits+2))
+        m.d.comb += [
+            integrator_signed.eq(integrator),
+            stepped.eq(Mux(self.comparator, integrator_signed + self.step,
+                integrator_signed - self.step)),
+        ]
+        with m.If(stepped < 0):
+            m.d.sync += integrator.eq(0)
+        with m.Elif(stepped > full_scale):
+            m.d.sync += integrator.eq(full_scale)
+        with m.Else():
+            m.d.sync += integrator.eq(stepped)
+
+        # First order sigma-delta onto the three steps of the two pin DAC
+        dac_error = Signal(bits)
+        dac_sum = Signal(bits+2)
+        m.d.comb += dac_sum.eq(dac_error + integrator*3)
+        m.d.sync += [
+            dac_error.eq(dac_sum[0:bits]),
+            self.feedback.eq(dac_sum[bits:]),
+        ]
+
+        # Accumulate and dump, as SigmaDelta_ADC
+        k_log2 = self.k.bit_length()-1
+        counter = Signal(k_log2)
+        accumulator = Signal(bits+k_log2)
+        raw_ready = Signal()
+        m.d.sync += [
+            counter.eq(counter+1),
+            accumulator.eq(accumulator + integrator),
+            raw_ready.eq(0),
+        ]
+        with m.If(counter==0):
+            m.d.sync += [
+                accumulator.eq(integrator),
+                self.raw_output.eq(accumulator[k_log2:]),
+                raw_ready.eq(1),
+            ]
+
+        # Calibration averages, the first half of the conversions let the loop settle on
+        # the reference and only the second half are summed
+        average_log2 = self.average_log2
+        measured = [Signal(bits, name="measured_low", reset=self.reference_codes[0]),
+            Signal(bits, name="measured_high", reset=self.reference_codes[1])]
+        measured_valid = [Signal(name="measured_low_valid"), Signal(name="measured_high_valid")]
+        average = Signal(bits+average_log2)
+        average_count = Signal(average_log2+2)
+        measured_done = Signal()
+        calibrating = Signal()
+        calibrate_high_last = Signal()
+        m.d.comb += calibrating.eq(self.calibrate_low_i | self.calibrate_high_i)
+        m.d.sync += [
+            measured_done.eq(0),
+            calibrate_high_last.eq(self.calibrate_high_i),
+        ]
+
+        # Restart between holds, and when going straight from one reference to the other
+        with m.If(~calibrating | (self.calibrate_high_i != calibrate_high_last)):
+            m.d.sync += [
+                average.eq(0),
+                average_count.eq(0),
+            ]
+        with m.Elif(average_count[-1]):
+            m.d.sync += [
+                average.eq(0),
+                average_count.eq(0),
+                measured_done.eq(1),
+            ]
+            for n, calibrate in enumerate([self.calibrate_low_i, self.calibrate_high_i]):
+                with m.If(calibrate):
+                    m.d.sync += [
+                        measured[n].eq(average[average_log2:]),
+                        measured_valid[n].eq(1),
+                    ]
+        with m.Elif(raw_ready):
+            m.d.sync += average_count.eq(average_count + 1)
+            with m.If(average_count[-2]):
+                m.d.sync += average.eq(average + self.raw_output)
+
+        # gain = (reference span << gain_bits)/(measured span), by restoring division one
+        # bit per clock after each completed measurement once both ends are known
+        gain_bits = self.gain_bits
+        reference_span = self.reference_codes[1] - self.reference_codes[0]
+        numerator_width = reference_span.bit_length() + gain_bits
+        gain = Signal(numerator_width, reset=2**gain_bits)
+        measured_span = Signal(signed(bits+1))
+        m.d.comb += measured_span.eq(measured[1] - measured[0])
+
+        numerator = Signal(numerator_width)
+        quotient = Signal(numerator_width)
+        remainder = Signal(bits+1)
+        shifted = Signal(bits+2)
+        trial = Signal(signed(bits+3))
+        next_quotient = Signal(numerator_width)
+        divide_count = Signal(range(numerator_width+1))
+        m.d.comb += [
+            shifted.eq(Cat(numerator[-1], remainder)),
+            trial.eq(shifted - measured_span),
+            next_quotient.eq(Cat(trial >= 0, quotient)),
+        ]
+
+        with m.If(divide_count != 0):
+            m.d.sync += [
+                numerator.eq(numerator << 1),
+                remainder.eq(Mux(trial >= 0, trial, shifted)),
+                quotient.eq(next_quotient),
+                divide_count.eq(divide_count - 1),
+            ]
+            with m.If(divide_count == 1):
+                m.d.sync += [
+                    gain.eq(next_quotient),
+                    self.calibrated_o.eq(1),
+                ]
+        with m.Elif(measured_done & measured_valid[0] & measured_valid[1] & (measured_span > 0)):
+            m.d.sync += [
+                numerator.eq(reference_span << gain_bits),
+                remainder.eq(0),
+                quotient.eq(0),
+                divide_count.eq(numerator_width),
+            ]
+
+        # Correct the raw output, clamped to the output range
+        raw_signed = Signal(signed(bits+1))
+        offset_removed = Signal(signed(bits+1))
+        corrected = Signal(signed(bits+numerator_width+2))
+        m.d.comb += [
+            raw_signed.eq(self.raw_output),
+            offset_removed.eq(raw_signed - measured[0]),
+            corrected.eq(((offset_removed*gain) >> gain_bits) + self.reference_codes[0]),
+        ]
+        m.d.sync += self.new_output.eq(raw_ready)
+        with m.If(raw_ready):
+            with m.If(corrected < 0):
+                m.d.sync += self.output.eq(0)
+            with m.Elif(corrected > full_scale):
+                m.d.sync += self.output.eq(full_scale)
+            with m.Else():
+                m.d.sync += self.output.eq(corrected)
+
+        return m
+
+    def model_output(self, raw, low_raws=(), high_raws=()):
+        # Bit-exact output for raw_output values raw, after calibration holds during which
+        # raw_output took the values low_raws (calibrate_low_i) and high_raws. The gain is
+        # from the last complete measurement of each, if the span between them is positive.
+        chunk = 2**(self.average_log2+1)
+        measured = list(self.reference_codes)
+        valid = [False, False]
+        for n, raws in enumerate([low_raws, high_raws]):
+            complete = len(raws)//chunk
+            if complete:
+                last = np.asarray(raws[(complete-1)*chunk:complete*chunk], dtype=np.int64)
+                measured[n] = int(np.sum(last[chunk//2:])) >> self.average_log2
+                valid[n] = True
+        gain = 2**self.gain_bits
+        if valid[0] and valid[1] and (measured[1] > measured[0]):
+            gain = ((self.reference_codes[1] - self.reference_codes[0]) << self.gain_bits)//(
+                measured[1] - measured[0])
+        corrected = (((np.asarray(raw, dtype=np.int64) - measured[0])*gain) >> self.gain_bits) + \
+            self.reference_codes[0]
+        return np.clip(corrected, 0, 2**self.bits-1)
+
 if __name__=="__main__":
+
+    # SigmaDelta_ADC_SecondOrder with a comparator offset and low supply, calibrated on
+    # 0.25 and 0.75 of the supply then read back at a few other inputs. The integrator slews
+    # full scale in 2**bits/step clocks, 8 conversions, so the first settle conversions of
+    # each reading are dropped and the rest averaged
+    adc = SigmaDelta_ADC_SecondOrder()
+    analog = dict(input=0.25, low=0, high=0)
+    readings = []
+    settle = 12
+    tolerance = 16
+    steps = [(0.25, 1, 0, 40), (0.75, 0, 1, 40), (0.1, 0, 0, settle+8), (0.5, 0, 0, settle+8),
+        (0.9, 0, 0, settle+8)]
+
+    def adc_circuit():
+        integrator = 0.5
+        supply = 0.98
+        offset = 0.01
+        while True:
+            feedback = yield adc.feedback
+            level = ((feedback >> 1)*1.0 + (feedback & 1)*0.5)/1.5*supply   # R and 2R
+            integrator += 0.05*(level-integrator)
+            yield adc.comparator.eq(analog['input'] > integrator+offset)
+            yield adc.calibrate_low_i.eq(analog['low'])
+            yield adc.calibrate_high_i.eq(analog['high'])
+            yield
+            if (yield adc.new_output):
+                readings.append((analog['input'], (yield adc.raw_output), (yield adc.output)))
+
+    def adc_control():
+        for input, low, high, conversions in steps:
+            analog.update(input=input, low=low, high=high)
+            for n in range(0, conversions*adc.k):
+                yield
+
+    sim = Simulator(adc)
+    sim.add_clock(10e-9) #100MHz
+    sim.add_sync_process(adc_circuit)
+    sim.add_sync_process(adc_control)
+    sim.run_until(10e-9*adc.k*sum(s[3] for s in steps))
+    for input in [0.1, 0.5, 0.9]:
+        settled = [r for r in readings if r[0]==input][settle:]
+        expected = round(input*2**adc.bits)
+        raw = sum(r[1] for r in settled)/len(settled)
+        corrected = sum(r[2] for r in settled)/len(settled)
+        print("Input", input, "expected", expected, "raw", round(raw, 1), "corrected",
+            round(corrected, 1), "over", len(settled), "conversions")
+        assert abs(corrected - expected) <= tolerance, "Calibrated reading out of tolerance"
+
     k = 15
     dut = SigmaDelta_ADC(k=k)
 
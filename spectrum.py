@@ -0,0 +1,75 @@
+import numpy as np
+from scipy import signal
+
+# Kaiser window with beta=38 has sidelobes far below anything a 24 bit datapath can produce,
+# at the cost of a main lobe about 25 bins wide
+window_beta = 38
+main_lobe_bins = 32
+
+def power_spectrum(samples):
+    samples = np.asarray(samples, dtype=np.float64)
+    samples = samples - np.mean(samples)
+    window = signal.windows.kaiser(len(samples), window_beta)
+    return np.abs(np.fft.rfft(samples*window))**2
+
+def sfdr_db(samples):
+    # Spurious free dynamic range in dB below the carrier. Works on non-coherent tones
+    # (any phi_inc), DC and the main lobe of the carrier are excluded
+    spectrum = power_spectrum(samples)
+    spectrum[0:main_lobe_bins] = 0
+    carrier = np.argmax(spectrum)
+    carrier_power = spectrum[carrier]
+    spectrum[max(0, carrier-main_lobe_bins):carrier+main_lobe_bins+1] = 0
+    return 10*np.log10(carrier_power/np.max(spectrum))
+
+def fit_sine(samples, frequency):
+    # Least squares fit of a sine of known frequency (cycles per sample) plus DC.
+    # Returns (amplitude, phase, offset, residual)
+    samples = np.asarray(samples, dtype=np.float64)
+    n = np.arange(len(samples))
+    basis = np.column_stack((np.sin(2*np.pi*frequency*n), np.cos(2*np.pi*frequency*n), np.ones(len(n))))
+    (a, b, offset), _, _, _ = np.linalg.lstsq(basis, samples, rcond=None)
+    residual = samples - basis.dot((a, b, offset))
+    return np.hypot(a, b), np.arctan2(b, a), offset, residual
+
+def sinad_db(samples, frequency):
+    # Signal to noise and distortion of a sine of known frequency
+    amplitude, phase, offset, residual = fit_sine(samples, frequency)
+    return 10*np.log10((amplitude**2/2)/np.mean(residual**2))
+
+def inband_snr_db(samples, frequency, osr):
+    # Signal to noise of an oversampled stream, counting only noise from DC (excluding the
+    # main lobe) up to the band edge at 0.5/osr cycles per sample
+    spectrum = power_spectrum(samples)
+    band = len(spectrum)//osr
+    tone = int(round(frequency*len(samples)))
+    signal_bins = slice(max(0, tone-main_lobe_bins), tone+main_lobe_bins+1)
+    signal_power = np.sum(spectrum[signal_bins])
+    spectrum[signal_bins] = 0
+    return 10*np.log10(signal_power/np.sum(spectrum[main_lobe_bins:band]))
+
+def thd_db(samples, frequency, osr=1, harmonics=5):
+    # Total harmonic distortion relative to the fundamental, from the 2nd up to the given
+    # harmonic, leaving out any beyond the band edge at 0.5/osr cycles per sample
+    spectrum = power_spectrum(samples)
+    band = len(spectrum)//osr
+
+    def tone_power(bin):
+        return np.sum(spectrum[max(0, bin-main_lobe_bins):bin+main_lobe_bins+1])
+
+    fundamental = tone_power(int(round(frequency*len(samples))))
+    distortion = 0
+    for harmonic in range(2, harmonics+1):
+        bin = int(round(harmonic*frequency*len(samples)))
+        if bin + main_lobe_bins < band:
+            distortion += tone_power(bin)
+    return 10*np.log10(distortion/fundamental) if distortion else -np.inf
+
+def largest_spur_db(samples, osr=1, full_scale=0.5):
+    # Largest in-band spectral line, in dB relative to a sine of amplitude full_scale, and its
+    # frequency in cycles per sample. For idle tones with a constant input.
+    spectrum = power_spectrum(samples)
+    band = len(spectrum)//osr
+    reference = (full_scale*np.sum(signal.windows.kaiser(len(samples), window_beta))/2)**2
+    spur = main_lobe_bins + np.argmax(spectrum[main_lobe_bins:band])
+    return 10*np.log10(spectrum[spur]/reference), spur/len(samples)